@@ -1,9 +1,10 @@
 import os
 import time
 import re
+import hashlib
 from urllib.parse import urlparse
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from asyncio import Semaphore
 import asyncio
@@ -13,8 +14,9 @@ from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
 from huggingface_hub import HfApi
-import requests
 import firmware_content_extractor as fce
+from dataset import ExistenceCache, HubDataset, LocalDataset, pointer_name
+from jobs import JobQueue
 
 def get_real_ip(request: Request):
     forwarded_for = request.headers.get("x-forwarded-for")
@@ -41,17 +43,40 @@ SUPPORTED_IMAGES = [
 ]
 
 extraction_semaphore = Semaphore(4)
+# Hash lookups only read a ROM's zip directory and payload manifest, so
+# they get their own, wider limit rather than waiting behind extractions.
+probe_semaphore = Semaphore(8)
 
 TEMP_DIR = "/tmp/extracted"
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+CACHE_DIR = os.getenv("FCE_CACHE_DIR")
+MEMORY_BUDGET = int(os.getenv("FCE_MEMORY_BUDGET_MB", "256")) * 1024 * 1024
+
+# Shared by all sessions, so a request for another image of a ROM that is
+# already being read reuses its parsed zip directory and payload manifest.
+index_cache = fce.MemoryIndexCache(CACHE_DIR)
+
+# Extractions in flight by (url, image); identical requests await the same
+# outcome instead of taking another slot.
+inflight = {}
+
 HF_TOKEN = os.getenv("HF_TOKEN")
 DATASET_REPO = "offici5l/fcetool"
+LOCAL_DATASET = os.getenv("FCE_LOCAL_DATASET")
+CONTENT_PREFIX = "sha256"
+
+# Images stored by content during this process: "<sha256>/<filename>" -> url.
+content_index = {}
 
 if HF_TOKEN:
-    hf_api = HfApi(token=HF_TOKEN)
+    dataset = HubDataset(HfApi(token=HF_TOKEN), DATASET_REPO)
+elif LOCAL_DATASET:
+    dataset = LocalDataset(LOCAL_DATASET, os.getenv("FCE_LOCAL_DATASET_URL"))
 else:
-    hf_api = None
+    dataset = None
+
+existence = ExistenceCache(dataset) if dataset else None
 
 def sanitize_path(path: str) -> str:
     path = re.sub(r'[<>:"|?*]', '_', path)
@@ -72,47 +97,203 @@ def generate_storage_path(url: str) -> str:
     full_path = f"{domain}/{path}"
     return full_path
 
-def check_file_in_dataset(storage_path: str, filename: str) -> bool:
-    if not hf_api:
-        return False
-    
+def is_remote_url(url) -> bool:
+    # The library can also read local paths; clients must not reach them.
+    return isinstance(url, str) and urlparse(url).scheme in ("http", "https")
+
+def invalid_url_response():
+    return JSONResponse(
+        status_code=400,
+        content={
+            "status": "error",
+            "message": "Invalid URL: Please provide a valid URL starting with http:// or https://"
+        }
+    )
+
+def content_path(digest: str) -> str:
+    return f"{CONTENT_PREFIX}/{digest}"
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+async def find_in_dataset(storage_path: str, filenames: list) -> dict:
+    # {filename: download url} for those stored under storage_path, either
+    # there or in the content store behind a pointer.
+    if not dataset:
+        return {}
+    found = await existence.find(storage_path, filenames)
+    return {
+        f: dataset.url(f"{storage_path if where is True else content_path(where)}/{f}")
+        for f, where in found.items()
+    }
+
+async def upload_to_dataset(source, storage_path: str, filename: str) -> str:
+    if not dataset:
+        raise Exception("HF_TOKEN not configured")
+    download_url = await dataset.upload(source, f"{storage_path}/{filename}", f"Add {filename} from {storage_path}")
+    existence.add(storage_path, filename)
+    return download_url
+
+async def link_content(storage_path: str, filename: str, digest: str):
+    # Lets the next request for this URL find the image from the folder
+    # listing instead of reading the payload manifest again.
     try:
-        path_in_repo = f"{storage_path}/{filename}"
-        exists = hf_api.file_exists(
-            repo_id=DATASET_REPO,
-            filename=path_in_repo,
-            repo_type="dataset"
-        )
-        return exists
+        await upload_to_dataset(b"", storage_path, pointer_name(filename, digest))
     except Exception:
+        pass
+
+async def find_by_content(url: str, filenames: list, storage_path: str, outcomes: dict) -> dict:
+    # Partition hashes from the payload manifest identify an image before
+    # any of its data is fetched, so the same image under another ROM URL
+    # is served from the dataset. Returns the hashes of the rest.
+    async with probe_semaphore:
+        identified = await fce.identify_async(url, filenames, cache_dir=CACHE_DIR, index_cache=index_cache)
+    digests = {r["filename"]: r["sha256"] for r in identified.get("results", []) if r.get("sha256")}
+    unknown = [(f, d) for f, d in digests.items() if f"{d}/{f}" not in content_index]
+    found = await asyncio.gather(*(find_in_dataset(content_path(d), [f]) for f, d in unknown))
+    for (filename, digest), present in zip(unknown, found):
+        if present:
+            content_index[f"{digest}/{filename}"] = dataset.url(f"{content_path(digest)}/{filename}")
+
+    for filename, digest in digests.items():
+        key = f"{digest}/{filename}"
+        if key in content_index:
+            await link_content(storage_path, filename, digest)
+            outcomes[filename] = (200, {
+                "status": "cached",
+                "message": "Identical image already exists in dataset (matched by hash)",
+                "download_url": content_index[key],
+                "filename": filename
+            })
+    return digests
+
+async def publish_extracted(result: dict, storage_path: str, digest: str = None):
+    filename = result["filename"]
+    raw_file_path = result.get("output_path")
+
+    if not result.get("success") or not os.path.exists(raw_file_path):
+        return 400, {
+            "status": "failed",
+            "message": result.get("error", "Extraction failed")
+        }
+
+    try:
+        if not dataset:
+            return 500, {
+                "status": "failed",
+                "message": "HF_TOKEN not configured. Cannot upload to dataset."
+            }
+
+        target = storage_path
+        if digest:
+            # Stored by content only once the bytes are known to match it.
+            loop = asyncio.get_event_loop()
+            if await loop.run_in_executor(None, file_sha256, raw_file_path) == digest:
+                target = content_path(digest)
+
         try:
-            url = f"https://huggingface.co/datasets/{DATASET_REPO}/resolve/main/{storage_path}/{filename}"
-            response = requests.get(url, stream=True, timeout=5)
-            response.close()
-            return response.status_code == 200
-        except:
-            return False
-
-async def upload_to_dataset(file_path: str, storage_path: str, filename: str) -> str:
-    if not hf_api:
-        raise Exception("HF_TOKEN not configured")
-    
-    path_in_repo = f"{storage_path}/{filename}"
-    
+            download_url = await upload_to_dataset(raw_file_path, target, filename)
+        except Exception as upload_error:
+            return 500, {
+                "status": "failed",
+                "message": f"Upload to dataset failed: {str(upload_error)}"
+            }
+
+        if target != storage_path:
+            content_index[f"{digest}/{filename}"] = download_url
+            await link_content(storage_path, filename, digest)
+
+        return 200, {
+            "status": "completed",
+            "message": "Extraction completed and uploaded to dataset",
+            "download_url": download_url,
+            "filename": filename
+        }
+    finally:
+        if os.path.exists(raw_file_path):
+            os.remove(raw_file_path)
+
+def no_report(filename: str, stage: str):
+    pass
+
+async def run_extraction(url: str, filenames: list, storage_path: str, report=no_report) -> dict:
+    outcomes = {}
+    digests = {}
+    if dataset:
+        try:
+            digests = await find_by_content(url, filenames, storage_path, outcomes)
+        except Exception:
+            digests = {}
+    missing = [f for f in filenames if f not in outcomes]
+
+    folder_name = storage_path.replace('/', '_')
+    out_dir = os.path.join(TEMP_DIR, folder_name)
+
+    if missing:
+        os.makedirs(out_dir, exist_ok=True)
+        try:
+            for filename in missing:
+                report(filename, "waiting")
+            async with extraction_semaphore:
+                for filename in missing:
+                    report(filename, "extracting")
+                result = await fce.extract_async(
+                    url, missing, out_dir, cache_dir=CACHE_DIR, memory_budget=MEMORY_BUDGET,
+                    index_cache=index_cache
+                )
+            
+            if "results" not in result:
+                for filename in missing:
+                    outcomes[filename] = (400, {
+                        "status": "failed",
+                        "message": result.get("error", "Extraction failed")
+                    })
+            else:
+                for r in result["results"]:
+                    report(r["filename"], "uploading")
+                    outcomes[r["filename"]] = await publish_extracted(r, storage_path, digests.get(r["filename"]))
+
+        except Exception as e:
+            for filename in missing:
+                outcomes[filename] = (500, {
+                    "status": "error",
+                    "message": str(e)
+                })
+        finally:
+            if os.path.exists(out_dir) and not os.listdir(out_dir):
+                os.rmdir(out_dir)
+    return outcomes
+
+async def extract_shared(url: str, filenames: list, storage_path: str, report=no_report) -> dict:
     loop = asyncio.get_event_loop()
-    await loop.run_in_executor(
-        None,
-        lambda: hf_api.upload_file(
-            path_or_fileobj=file_path,
-            path_in_repo=path_in_repo,
-            repo_id=DATASET_REPO,
-            repo_type="dataset",
-            commit_message=f"Add {filename} from {storage_path}"
-        )
-    )
-    
-    download_url = f"https://huggingface.co/datasets/{DATASET_REPO}/resolve/main/{path_in_repo}"
-    return download_url
+    joined = {f: inflight[(url, f)] for f in filenames if (url, f) in inflight}
+    own = [f for f in filenames if f not in joined]
+    futures = {f: loop.create_future() for f in own}
+    for f in own:
+        inflight[(url, f)] = futures[f]
+    for f in joined:
+        report(f, "extracting")
+
+    try:
+        if own:
+            outcomes = await run_extraction(url, own, storage_path, report)
+            for f in own:
+                futures[f].set_result(outcomes[f])
+    finally:
+        for f in own:
+            if not futures[f].done():
+                futures[f].set_result((500, {"status": "error", "message": "Extraction was interrupted"}))
+            inflight.pop((url, f), None)
+
+    results = {f: futures[f].result() for f in own}
+    for f, future in joined.items():
+        results[f] = await asyncio.shield(future)
+    # Waiters share the outcome, so each gets its own copy to annotate.
+    return {f: (code, dict(content)) for f, (code, content) in results.items()}
 
 @app.exception_handler(RateLimitExceeded)
 async def rate_limit_handler(request: Request, exc: RateLimitExceeded):
@@ -144,144 +325,240 @@ async def global_exception_handler(request: Request, exc: Exception):
         }
     )
 
+def parse_images(payload: dict):
+    # (filenames, single) for a request body, or an error response.
+    url = payload.get("url")
+    images = payload.get("images")
+
+    if not url or not images:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": "Missing 'url' or 'images' parameter in JSON body."
+            }
+        )
+
+    if not is_remote_url(url):
+        return invalid_url_response()
+
+    single = isinstance(images, str)
+    filenames = [images] if single else images
+    if not isinstance(filenames, list) or any(f not in SUPPORTED_IMAGES for f in filenames):
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": f"Unsupported image type. Supported: {', '.join(SUPPORTED_IMAGES)}"
+            }
+        )
+    return list(dict.fromkeys(filenames)), single
+
+async def find_cached(storage_path: str, filenames: list) -> dict:
+    outcomes = {}
+    for filename, download_url in (await find_in_dataset(storage_path, filenames)).items():
+        outcomes[filename] = (200, {
+            "status": "cached",
+            "message": "File already exists in dataset (from cache)",
+            "download_url": download_url,
+            "filename": filename
+        })
+    return outcomes
+
+def summarize(outcomes: dict, filenames: list, single: bool, duration: int):
+    if single:
+        status_code, content = outcomes[filenames[0]]
+        if content["status"] != "error":
+            content["duration_seconds"] = duration
+        return status_code, content
+
+    ok = [outcomes[f][0] == 200 for f in filenames]
+    return 200 if any(ok) else 400, {
+        "status": "completed" if all(ok) else ("partial" if any(ok) else "failed"),
+        "results": [dict(outcomes[f][1], filename=f) for f in filenames],
+        "duration_seconds": duration
+    }
+
+async def run_job(job: dict):
+    url, filenames, single = job["request"]["url"], job["request"]["images"], job["request"]["single"]
+    progress = job["progress"]
+
+    def report(filename: str, stage: str):
+        progress[filename] = stage
+
+    start_time = time.time()
+    storage_path = generate_storage_path(url)
+    outcomes = await find_cached(storage_path, filenames)
+    missing = [f for f in filenames if f not in outcomes]
+    if missing:
+        outcomes.update(await extract_shared(url, missing, storage_path, report))
+    for filename, (_, content) in outcomes.items():
+        report(filename, content["status"])
+    return summarize(outcomes, filenames, single, int(time.time() - start_time))
+
+def job_priority(filenames: list) -> str:
+    # Set here rather than by the client: jobs needing fewer extractions
+    # go first, so quick requests are not stuck behind long ones.
+    if len(filenames) == 1:
+        return "high"
+    return "normal" if len(filenames) <= 3 else "low"
+
+job_queue = JobQueue(
+    run_job,
+    workers=int(os.getenv("FCE_JOB_WORKERS", "4")),
+    max_queued=int(os.getenv("FCE_JOB_QUEUE", "64"))
+)
+
 @app.post("/extract")
 @limiter.limit("3/minute")
 async def extract_images(request: Request, payload: dict):
-    if extraction_semaphore.locked():
+    parsed = parse_images(payload)
+    if isinstance(parsed, JSONResponse):
+        return parsed
+    filenames, single = parsed
+    url = payload["url"]
+
+    start_time = time.time()
+    storage_path = generate_storage_path(url)
+    outcomes = await find_cached(storage_path, filenames)
+
+    missing = [f for f in filenames if f not in outcomes]
+    if missing:
+        if extraction_semaphore.locked() and any((url, f) not in inflight for f in missing):
+            return JSONResponse(
+                status_code=429,
+                content={
+                    "status": "error",
+                    "message": "Server is at full capacity. Please try again in 1-2 minutes."
+                }
+            )
+        outcomes.update(await extract_shared(url, missing, storage_path))
+
+    status_code, content = summarize(outcomes, filenames, single, int(time.time() - start_time))
+    return JSONResponse(status_code=status_code, content=content)
+
+@app.post("/jobs")
+@limiter.limit("3/minute")
+async def submit_job(request: Request, payload: dict):
+    parsed = parse_images(payload)
+    if isinstance(parsed, JSONResponse):
+        return parsed
+    filenames, single = parsed
+
+    try:
+        job = job_queue.submit(
+            get_real_ip(request),
+            {"url": payload["url"], "images": filenames, "single": single},
+            job_priority(filenames)
+        )
+    except asyncio.QueueFull as e:
         return JSONResponse(
             status_code=429,
             content={
                 "status": "error",
-                "message": "Server is at full capacity. Please try again in 1-2 minutes."
+                "message": str(e)
             }
         )
+    return JSONResponse(status_code=202, content=job_queue.view(job))
 
-    url = payload.get("url")
-    filename = payload.get("images")
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_queue.jobs.get(job_id)
+    if job is None:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "status": "error",
+                "message": "Job not found or expired"
+            }
+        )
+    return JSONResponse(status_code=200, content=job_queue.view(job))
 
-    if not url or not filename:
+@app.post("/stream")
+@limiter.limit("3/minute")
+async def stream_image(request: Request, payload: dict):
+    if extraction_semaphore.locked():
         return JSONResponse(
-            status_code=400,
+            status_code=429,
             content={
                 "status": "error",
-                "message": "Missing 'url' or 'images' parameter in JSON body."
+                "message": "Server is at full capacity. Please try again in 1-2 minutes."
             }
         )
 
-    if filename not in SUPPORTED_IMAGES:
+    url = payload.get("url")
+    image = payload.get("image")
+
+    if not url or not image:
         return JSONResponse(
             status_code=400,
             content={
                 "status": "error",
-                "message": f"Unsupported image type. Supported: {', '.join(SUPPORTED_IMAGES)}"
+                "message": "Missing 'url' or 'image' parameter in JSON body."
             }
         )
 
-    start_time = time.time()
-    storage_path = generate_storage_path(url)
-    
-    if hf_api and check_file_in_dataset(storage_path, filename):
-        cache_url = f"https://huggingface.co/datasets/{DATASET_REPO}/resolve/main/{storage_path}/{filename}"
+    if not is_remote_url(url):
+        return invalid_url_response()
+
+    if image not in SUPPORTED_IMAGES:
         return JSONResponse(
-            status_code=200,
+            status_code=400,
             content={
-                "status": "cached",
-                "message": "File already exists in dataset (from cache)",
-                "download_url": cache_url,
-                "filename": filename,
-                "duration_seconds": int(time.time() - start_time)
+                "status": "error",
+                "message": f"Unsupported image type. Supported: {', '.join(SUPPORTED_IMAGES)}"
             }
         )
 
-    folder_name = storage_path.replace('/', '_')
-    out_dir = os.path.join(TEMP_DIR, folder_name)
-    raw_file_path = os.path.normpath(os.path.join(out_dir, filename))
+    await extraction_semaphore.acquire()
+    sink = fce.AsyncIterSink()
+    task = asyncio.ensure_future(fce.extract_async(
+        url, image, TEMP_DIR, cache_dir=CACHE_DIR, memory_budget=MEMORY_BUDGET, sinks={image: sink},
+        index_cache=index_cache
+    ))
+    # The slot is held until the extraction itself ends, however the
+    # response does.
+    task.add_done_callback(lambda _: extraction_semaphore.release())
 
-    os.makedirs(out_dir, exist_ok=True)
-    
     try:
-        async with extraction_semaphore:
-            result = await fce.extract_async(url, filename, out_dir)
-        
-        if result.get("success") and os.path.exists(raw_file_path):
-            if hf_api:
-                try:
-                    download_url = await upload_to_dataset(raw_file_path, storage_path, filename)
-                    
-                    os.remove(raw_file_path)
-                    if os.path.exists(out_dir) and not os.listdir(out_dir):
-                        os.rmdir(out_dir)
-                    
-                    end_time = time.time()
-                    duration = int(end_time - start_time)
-
-                    return JSONResponse(
-                        status_code=200,
-                        content={
-                            "status": "completed",
-                            "message": "Extraction completed and uploaded to dataset",
-                            "download_url": download_url,
-                            "filename": filename,
-                            "duration_seconds": duration
-                        }
-                    )
-                
-                except Exception as upload_error:
-                    if os.path.exists(raw_file_path):
-                        os.remove(raw_file_path)
-                    if os.path.exists(out_dir) and not os.listdir(out_dir):
-                        os.rmdir(out_dir)
-                    
-                    return JSONResponse(
-                        status_code=500,
-                        content={
-                            "status": "failed",
-                            "message": f"Upload to dataset failed: {str(upload_error)}",
-                            "duration_seconds": int(time.time() - start_time)
-                        }
-                    )
-            else:
-                if os.path.exists(raw_file_path):
-                    os.remove(raw_file_path)
-                if os.path.exists(out_dir) and not os.listdir(out_dir):
-                    os.rmdir(out_dir)
-                
-                return JSONResponse(
-                    status_code=500,
-                    content={
-                        "status": "failed",
-                        "message": "HF_TOKEN not configured. Cannot upload to dataset.",
-                        "duration_seconds": int(time.time() - start_time)
-                    }
-                )
-        else:
-            if os.path.exists(out_dir) and not os.listdir(out_dir):
-                os.rmdir(out_dir)
-            
-            return JSONResponse(
-                status_code=400, 
-                content={
-                    "status": "failed", 
-                    "message": result.get("error", "Extraction failed"),
-                    "duration_seconds": int(time.time() - start_time)
-                }
-            )
-
+        size = await sink.opened()
+    except asyncio.CancelledError:
+        sink.cancel()
+        raise
     except Exception as e:
-        if os.path.exists(out_dir) and not os.listdir(out_dir):
-            os.rmdir(out_dir)
+        result = await task
         return JSONResponse(
-            status_code=500,
+            status_code=400,
             content={
-                "status": "error",
-                "message": str(e)
+                "status": "failed",
+                "message": result.get("error", str(e))
             }
         )
 
+    async def body():
+        try:
+            async for chunk in sink:
+                yield chunk
+        finally:
+            # Nothing is awaited here: after a disconnect the generator is
+            # cancelled again at every await. The extraction stops at its
+            # next write once the sink is cancelled.
+            sink.cancel()
+
+    return StreamingResponse(
+        body(),
+        media_type="application/octet-stream",
+        headers={
+            "Content-Length": str(size),
+            "Content-Disposition": f'attachment; filename="{image}"'
+        }
+    )
+
 @app.get("/files/{storage_path:path}/{filename}")
 async def get_file_info(storage_path: str, filename: str):
-    if check_file_in_dataset(storage_path, filename):
-        download_url = f"https://huggingface.co/datasets/{DATASET_REPO}/resolve/main/{storage_path}/{filename}"
+    found = await find_in_dataset(storage_path, [filename])
+    if filename in found:
+        download_url = found[filename]
         return JSONResponse(
             status_code=200,
             content={
@@ -312,7 +589,7 @@ async def health_check():
 
 @app.get("/")
 def home():
-    hf_status = "enabled" if hf_api else "disabled"
+    hf_status = "enabled" if dataset else "disabled"
     return JSONResponse(
         status_code=200,
         content={
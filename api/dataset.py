@@ -0,0 +1,151 @@
+import asyncio
+import os
+import shutil
+import time
+from huggingface_hub.hf_api import RepoFile
+from huggingface_hub.utils import EntryNotFoundError
+
+FOUND_TTL = 600
+MISSING_TTL = 60
+POINTER_TAG = ".sha256-"
+
+def pointer_name(filename: str, digest: str) -> str:
+    # An empty file next to URL-keyed images naming where the content is
+    # stored, so a folder listing alone resolves it.
+    return f"{filename}{POINTER_TAG}{digest}"
+
+def resolve(files: set, filename: str):
+    # True if the file itself is listed, the digest a pointer names, or None.
+    if filename in files:
+        return True
+    prefix = f"{filename}{POINTER_TAG}"
+    return next((f[len(prefix):] for f in files if f.startswith(prefix)), None)
+
+class HubDataset:
+    def __init__(self, api, repo_id):
+        self.api = api
+        self.repo_id = repo_id
+
+    def url(self, path_in_repo: str) -> str:
+        return f"https://huggingface.co/datasets/{self.repo_id}/resolve/main/{path_in_repo}"
+
+    def list_files(self, folder: str) -> set:
+        try:
+            entries = self.api.list_repo_tree(
+                repo_id=self.repo_id,
+                path_in_repo=folder,
+                repo_type="dataset"
+            )
+            return {e.path.rpartition("/")[2] for e in entries if isinstance(e, RepoFile)}
+        except EntryNotFoundError:
+            return set()
+
+    async def upload(self, source, path_in_repo: str, message: str) -> str:
+        # source is a file path or the bytes themselves.
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            None,
+            lambda: self.api.upload_file(
+                path_or_fileobj=source,
+                path_in_repo=path_in_repo,
+                repo_id=self.repo_id,
+                repo_type="dataset",
+                commit_message=message
+            )
+        )
+        return self.url(path_in_repo)
+
+
+class LocalDataset:
+    # A directory standing in for the Hub dataset, to run the API without
+    # a token, e.g. in tests or a local deployment.
+    def __init__(self, root: str, base_url: str = None):
+        self.root = os.path.abspath(root)
+        self.base_url = (base_url or f"file://{self.root}").rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, path_in_repo: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, path_in_repo))
+        if not path.startswith(self.root + os.sep):
+            raise Exception(f"Invalid dataset path: {path_in_repo}")
+        return path
+
+    def url(self, path_in_repo: str) -> str:
+        return f"{self.base_url}/{path_in_repo}"
+
+    def list_files(self, folder: str) -> set:
+        path = self._path(folder)
+        if not os.path.isdir(path):
+            return set()
+        return {f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) and not f.endswith(".part")}
+
+    async def upload(self, source, path_in_repo: str, message: str) -> str:
+        target = self._path(path_in_repo)
+
+        def copy():
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if isinstance(source, bytes):
+                with open(target + ".part", "wb") as f:
+                    f.write(source)
+            else:
+                shutil.copyfile(source, target + ".part")
+            os.replace(target + ".part", target)
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, copy)
+        return self.url(path_in_repo)
+
+
+class ExistenceCache:
+    # Which files a dataset folder holds, from one listing per folder that
+    # concurrent lookups share. A file seen in a listing is trusted for
+    # FOUND_TTL; a missing one only for MISSING_TTL, since another replica
+    # may upload it meanwhile.
+    def __init__(self, dataset, found_ttl: float = FOUND_TTL, missing_ttl: float = MISSING_TTL):
+        self.dataset = dataset
+        self.found_ttl = found_ttl
+        self.missing_ttl = missing_ttl
+        self._folders = {}
+        self._listing = {}
+
+    async def _list(self, folder: str) -> set:
+        if folder not in self._listing:
+            loop = asyncio.get_event_loop()
+            self._listing[folder] = loop.run_in_executor(None, self.dataset.list_files, folder)
+        future = self._listing[folder]
+        try:
+            files = await asyncio.shield(future)
+        finally:
+            if self._listing.get(folder) is future and future.done():
+                del self._listing[folder]
+        self._folders[folder] = (time.monotonic(), files)
+        return files
+
+    def _resolve_all(self, files: set, filenames: list) -> dict:
+        found = {f: resolve(files, f) for f in filenames}
+        return {f: where for f, where in found.items() if where}
+
+    async def find(self, folder: str, filenames: list) -> dict:
+        # {filename: True or the digest of a pointer} for those present.
+        entry = self._folders.get(folder)
+        if entry:
+            listed, files = entry
+            age = time.monotonic() - listed
+            found = self._resolve_all(files, filenames)
+            if age < (self.found_ttl if len(found) == len(filenames) else self.missing_ttl):
+                return found
+        try:
+            files = await self._list(folder)
+        except Exception:
+            # Not cached, so the next lookup tries again.
+            return {}
+        return self._resolve_all(files, filenames)
+
+    async def exists(self, folder: str, filename: str) -> bool:
+        return filename in await self.find(folder, [filename])
+
+    def add(self, folder: str, filename: str):
+        # A folder not listed yet is left alone: a listing of one file
+        # would report its siblings missing.
+        if folder in self._folders:
+            self._folders[folder][1].add(filename)
@@ -0,0 +1,115 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict, deque
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+JOB_TTL = 3600
+
+class JobQueue:
+    # Jobs wait by priority; within a priority the clients with queued
+    # jobs take turns, so one address submitting many jobs does not hold
+    # up everyone else. run(job) returns the (status_code, content) result.
+    def __init__(self, run, workers: int = 4, max_queued: int = 64, max_per_client: int = 4, ttl: float = JOB_TTL):
+        self.run = run
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_per_client = max_per_client
+        self.ttl = ttl
+        self.jobs = {}
+        self._levels = [OrderedDict() for _ in PRIORITIES]
+        self._queued = 0
+        self._active = {}
+        self._available = None
+        self._tasks = []
+
+    def _start(self):
+        # Workers need a running loop, so they start with the first job.
+        if self._tasks:
+            return
+        self._available = asyncio.Semaphore(0)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, client: str, request: dict, priority: str = "normal") -> dict:
+        self._expire()
+        if self._queued >= self.max_queued:
+            raise asyncio.QueueFull("Job queue is full. Please try again in a few minutes.")
+        if self._active.get(client, 0) >= self.max_per_client:
+            raise asyncio.QueueFull(f"At most {self.max_per_client} jobs per client can be pending.")
+        self._start()
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "client": client,
+            "priority": priority,
+            "request": request,
+            "status": "queued",
+            "progress": {},
+            "result": None,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+        }
+        self.jobs[job["id"]] = job
+        self._levels[PRIORITIES[priority]].setdefault(client, deque()).append(job)
+        self._queued += 1
+        self._active[client] = self._active.get(client, 0) + 1
+        self._available.release()
+        return job
+
+    def _order(self):
+        # Queued jobs in the order they will run.
+        for level in self._levels:
+            queues = [list(q) for q in level.values()]
+            for k in range(max(map(len, queues), default=0)):
+                for q in queues:
+                    if k < len(q):
+                        yield q[k]
+
+    def _pop(self) -> dict:
+        for level in self._levels:
+            if level:
+                client, queue = next(iter(level.items()))
+                job = queue.popleft()
+                del level[client]
+                if queue:
+                    level[client] = queue
+                self._queued -= 1
+                return job
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [k for k, job in self.jobs.items() if job["finished"] and job["finished"] < cutoff]:
+            del self.jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            await self._available.acquire()
+            job = self._pop()
+            job["status"] = "running"
+            job["started"] = time.time()
+            try:
+                job["result"] = await self.run(job)
+            except Exception as e:
+                job["result"] = (500, {"status": "error", "message": str(e)})
+            finally:
+                job["status"] = "done"
+                job["finished"] = time.time()
+                self._active[job["client"]] -= 1
+                if not self._active[job["client"]]:
+                    del self._active[job["client"]]
+
+    def view(self, job: dict) -> dict:
+        out = {
+            "job_id": job["id"],
+            "status": job["status"],
+            "priority": job["priority"],
+            "progress": dict(job["progress"]),
+        }
+        if job["status"] == "queued":
+            out["position"] = next(k for k, queued in enumerate(self._order()) if queued is job)
+        if job["started"]:
+            out["queued_seconds"] = int(job["started"] - job["created"])
+        if job["result"] is not None:
+            out["result"] = job["result"][1]
+        return out
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, API_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(API_DIR), "fcetool"))
+
+# The app picks its dataset at import: a local directory, never the Hub.
+os.environ.pop("HF_TOKEN", None)
+os.environ["FCE_LOCAL_DATASET"] = tempfile.mkdtemp(prefix="fce-dataset-")
@@ -0,0 +1,97 @@
+import asyncio
+import os
+
+import pytest
+
+from dataset import ExistenceCache, LocalDataset, pointer_name
+
+DIGEST = "ab" * 32
+
+class CountingDataset(LocalDataset):
+    def __init__(self, root):
+        super().__init__(root)
+        self.listings = 0
+
+    def list_files(self, folder):
+        self.listings += 1
+        return super().list_files(folder)
+
+def put(dataset, path_in_repo, data=b"x"):
+    path = os.path.join(dataset.root, path_in_repo)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def test_one_listing_for_concurrent_lookups(tmp_path):
+    dataset = CountingDataset(tmp_path)
+    put(dataset, "rom/boot.img")
+    put(dataset, f"rom/{pointer_name('dtbo.img', DIGEST)}", b"")
+    cache = ExistenceCache(dataset)
+
+    async def main():
+        return await asyncio.gather(
+            cache.find("rom", ["boot.img", "dtbo.img", "vbmeta.img"]),
+            *(cache.exists("rom", "boot.img") for _ in range(5))
+        )
+
+    found, *exists = asyncio.run(main())
+    assert found == {"boot.img": True, "dtbo.img": DIGEST}
+    assert all(exists)
+    assert dataset.listings == 1
+
+def test_found_and_missing_ttls(tmp_path):
+    dataset = CountingDataset(tmp_path)
+    put(dataset, "rom/boot.img")
+    cache = ExistenceCache(dataset, found_ttl=60, missing_ttl=0.05)
+
+    async def main():
+        assert await cache.exists("rom", "boot.img")
+        assert not await cache.exists("rom", "dtbo.img")
+        put(dataset, "rom/dtbo.img")
+        # Within both TTLs the listing is reused, missing file and all.
+        assert not await cache.exists("rom", "dtbo.img")
+        assert dataset.listings == 1
+        await asyncio.sleep(0.1)
+        assert await cache.exists("rom", "boot.img")
+        assert dataset.listings == 1
+        assert await cache.exists("rom", "dtbo.img")
+        assert dataset.listings == 2
+
+    asyncio.run(main())
+
+def test_uploads_update_listed_folders_only(tmp_path):
+    dataset = CountingDataset(tmp_path)
+    cache = ExistenceCache(dataset)
+
+    async def main():
+        assert not await cache.exists("rom", "boot.img")
+        put(dataset, "rom/boot.img")
+        cache.add("rom", "boot.img")
+        assert await cache.exists("rom", "boot.img")
+        put(dataset, "other/boot.img")
+        cache.add("other", "boot.img")
+        put(dataset, "other/dtbo.img")
+        assert await cache.find("other", ["boot.img", "dtbo.img"]) == {"boot.img": True, "dtbo.img": True}
+        assert dataset.listings == 2
+
+    asyncio.run(main())
+
+def test_failed_listing_is_not_cached(tmp_path):
+    dataset = CountingDataset(tmp_path)
+    cache = ExistenceCache(dataset)
+
+    async def main():
+        assert await cache.find("../outside", ["boot.img"]) == {}
+        assert await cache.find("../outside", ["boot.img"]) == {}
+        assert dataset.listings == 2
+
+    asyncio.run(main())
+
+def test_local_dataset_upload(tmp_path):
+    dataset = LocalDataset(tmp_path / "root")
+    url = asyncio.run(dataset.upload(b"boot", "rom/boot.img", "test"))
+    assert url == f"file://{tmp_path / 'root'}/rom/boot.img"
+    assert dataset.list_files("rom") == {"boot.img"}
+    with pytest.raises(Exception, match="Invalid dataset path"):
+        asyncio.run(dataset.upload(b"x", "../escape.img", "test"))
+    assert not os.path.exists(tmp_path / "escape.img")
@@ -0,0 +1,156 @@
+import asyncio
+import os
+
+import httpx
+import pytest
+
+import app as api
+from jobs import JobQueue
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def settle(queue):
+    while any(job["status"] != "done" for job in queue.jobs.values()):
+        await asyncio.sleep(0.01)
+
+def client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://test")
+
+def test_priority_then_client_turns():
+    async def main():
+        order = []
+
+        async def work(job):
+            order.append(job["request"])
+            return 200, {"status": "completed"}
+
+        queue = JobQueue(work, workers=1)
+        for client_ip, name, priority in [
+            ("a", "a1", "normal"), ("a", "a2", "normal"), ("a", "a3", "normal"),
+            ("b", "b1", "normal"), ("c", "c1", "low"), ("d", "d1", "high"),
+        ]:
+            job = queue.submit(client_ip, name, priority)
+        assert queue.view(job)["position"] == 0
+        assert [j["request"] for j in queue._order()] == ["d1", "a1", "b1", "a2", "a3", "c1"]
+        await settle(queue)
+        return order
+
+    assert run(main()) == ["d1", "a1", "b1", "a2", "a3", "c1"]
+
+def test_submit_limits():
+    async def main():
+        async def work(job):
+            return 200, {}
+
+        queue = JobQueue(work, workers=1, max_queued=3, max_per_client=2)
+        queue.submit("a", 1)
+        queue.submit("a", 2)
+        with pytest.raises(asyncio.QueueFull, match="per client"):
+            queue.submit("a", 3)
+        queue.submit("b", 4)
+        with pytest.raises(asyncio.QueueFull, match="queue is full"):
+            queue.submit("c", 5)
+        await settle(queue)
+        # Finished jobs no longer count against their client.
+        queue.submit("a", 6)
+        await settle(queue)
+
+    run(main())
+
+def test_failed_job_and_expiry():
+    async def main():
+        async def work(job):
+            raise Exception("boom")
+
+        queue = JobQueue(work, workers=1, ttl=0)
+        first = queue.submit("a", 1)
+        await settle(queue)
+        assert queue.view(first)["result"] == {"status": "error", "message": "boom"}
+        queue.submit("a", 2)
+        assert first["id"] not in queue.jobs
+        await settle(queue)
+
+    run(main())
+
+def test_job_served_from_local_dataset():
+    storage_path = api.generate_storage_path("https://example.com/roms/rom.zip")
+    path = os.path.join(os.environ["FCE_LOCAL_DATASET"], storage_path, "boot.img")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"boot")
+
+    async def main():
+        async with client() as c:
+            r = await c.post(
+                "/jobs", json={"url": "https://example.com/roms/rom.zip", "images": "boot.img"},
+                headers={"x-forwarded-for": "10.0.1.1"}
+            )
+            assert r.status_code == 202
+            assert r.json()["priority"] == "high"
+            job_id = r.json()["job_id"]
+            while True:
+                view = (await c.get(f"/jobs/{job_id}")).json()
+                if view["status"] == "done":
+                    return view
+                await asyncio.sleep(0.01)
+
+    view = run(main())
+    assert view["progress"] == {"boot.img": "cached"}
+    assert view["result"]["status"] == "cached"
+    assert view["result"]["download_url"] == api.dataset.url(f"{storage_path}/boot.img")
+
+def test_http_errors(monkeypatch):
+    async def main():
+        release = asyncio.Event()
+
+        async def work(job):
+            await release.wait()
+            return 200, {"status": "completed"}
+
+        monkeypatch.setattr(api, "job_queue", JobQueue(work, workers=1, max_queued=1))
+        body = {"url": "https://example.com/rom.zip", "images": ["boot.img", "dtbo.img"]}
+        async with client() as c:
+            ids = []
+            for k in range(3):
+                r = await c.post("/jobs", json=body, headers={"x-forwarded-for": f"10.0.2.{k}"})
+                status = r.status_code
+                if status == 202:
+                    ids.append(r.json()["job_id"])
+                    assert r.json()["priority"] == "normal"
+                    # Wait for the worker to take the first job off the queue.
+                    while k == 0 and (await c.get(f"/jobs/{ids[0]}")).json()["status"] != "running":
+                        await asyncio.sleep(0.01)
+            assert len(ids) == 2 and status == 429
+
+            r = await c.post(
+                "/jobs", json={"url": "file:///etc/passwd", "images": "boot.img"},
+                headers={"x-forwarded-for": "10.0.2.9"}
+            )
+            assert r.status_code == 400
+            assert (await c.get("/jobs/missing")).status_code == 404
+            release.set()
+            await settle(api.job_queue)
+
+    run(main())
+
+def test_hash_lookups_are_limited(monkeypatch):
+    running = peak = 0
+
+    async def identify(url, filenames, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return {"success": True, "results": []}
+
+    monkeypatch.setattr(api.fce, "identify_async", identify)
+
+    async def main():
+        await asyncio.gather(*(
+            api.find_by_content(f"https://example.com/{k}.zip", ["boot.img"], f"rom{k}", {}) for k in range(20)
+        ))
+
+    run(main())
+    assert peak == 8
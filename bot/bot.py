@@ -20,13 +20,17 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes
 )
+import asyncio
+import time
 import httpx
 
 TOKEN = os.getenv("BOT_TOKEN") 
 if not TOKEN:
     exit("Error: BOT_TOKEN not found in environment variables!")
 
-API_URL = "https://offici5l-fcetool.hf.space/extract"
+API_URL = "https://offici5l-fcetool.hf.space/jobs"
+JOB_WAIT = 40
+POLL_INTERVAL = 2
 GITHUB_URL = "https://github.com/offici5l/fcetool"
 WEB_URL = "https://offici5l.github.io/fcetool"
 CHANNEL_URL = "https://t.me/Offici5l_Channel"
@@ -89,7 +93,20 @@ async def fetch_extraction_data(url: str, image_name: str) -> dict:
                 json=payload
             )
             response.raise_for_status()
-            return response.json()
+            job = response.json()
+
+            # The extraction keeps running on the server after the wait
+            # runs out; asking again later finds the image cached.
+            deadline = time.monotonic() + JOB_WAIT
+            while job.get("status") != "done" and time.monotonic() < deadline:
+                await asyncio.sleep(POLL_INTERVAL)
+                response = await client.get(f"{API_URL}/{job['job_id']}")
+                response.raise_for_status()
+                job = response.json()
+
+            if job.get("status") != "done":
+                return {"status": "processing"}
+            return job.get("result")
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 400:
                 try:
@@ -259,6 +276,22 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     thumbnail_url="https://img.icons8.com/color/96/download--v1.png"
                 )
             ]
+        elif api_data and api_data.get("status") == "processing":
+            results = [
+                InlineQueryResultArticle(
+                    id=str(uuid4()),
+                    title=f"⏳ Extracting {image_name}",
+                    description="Still in progress. Repeat the query in a minute.",
+                    input_message_content=InputTextMessageContent(
+                        f"⏳ *Extraction In Progress*\n\n"
+                        f"📂 *Requested File:* `{escape_markdown(image_name)}`\n\n"
+                        f"The image is still being extracted\\. Repeat the query in a minute to get the download link\\.",
+                        parse_mode=ParseMode.MARKDOWN_V2,
+                        disable_web_page_preview=True
+                    ),
+                    thumbnail_url="https://img.icons8.com/color/96/hourglass.png"
+                )
+            ]
         elif api_data and api_data.get("status") == "failed":
             error_msg = api_data.get("message", "Unknown error occurred")
             
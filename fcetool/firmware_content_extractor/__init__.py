@@ -1 +1,3 @@
-from .cli import extract_async
\ No newline at end of file
+from .cli import extract_async, identify_async
+from .cache import MemoryIndexCache
+from .sinks import AsyncIterSink, FileSink, MmapSink, StreamSink
@@ -0,0 +1,113 @@
+import asyncio
+from .network import SubFileClient
+from .parser import ZipParser
+from .payload import PayloadExtractor
+from .superimg import SuperExtractor
+from .zran import ZRAN_AVAILABLE, InflatedFileClient
+
+NESTED_PROBE_LIMIT = 4
+# A deflated inner zip costs a full download and inflate to index. With
+# nowhere to keep that index it is paid again next run, so only small
+# ones are probed then.
+NESTED_INFLATE_LIMIT = 256 * 1024 * 1024
+
+class ArchiveTree:
+    def __init__(self, memory_budget=None, temp_dir=None):
+        self.memory_budget = memory_budget
+        self.temp_dir = temp_dir
+        self.entries = {}
+        self._by_name = {}
+        self._extractors = []
+
+    def _add(self, path, entry):
+        self.entries[path] = entry
+        # Shallower levels are added first, so they win name lookups.
+        self._by_name.setdefault(path.split('/')[-1].lower(), path)
+
+    def find(self, filename):
+        path = self._by_name.get(filename.lower())
+        return self.entries[path] if path else None
+
+    def missing(self, targets):
+        return [t for t in targets if t.lower() not in self._by_name]
+
+    async def _add_level(self, prefix, client, parser, targets):
+        for name in parser.files:
+            self._add(prefix + name, {"kind": "file", "client": client, "parser": parser, "name": name})
+
+        if "payload.bin" in parser.files and self.missing(targets):
+            extractor = PayloadExtractor(client, parser, self.memory_budget, temp_dir=self.temp_dir)
+            self._extractors.append(extractor)
+            try:
+                manifest, _ = await extractor.load_manifest()
+            except Exception:
+                return
+            for p_name in manifest.partitions:
+                self._add(f"{prefix}payload.bin/{p_name}.img", {"kind": "payload", "extractor": extractor, "name": p_name})
+
+        # Logical partitions are read straight out of a stored super image;
+        # a deflated one could only be walked by inflating all of it.
+        supers = [n for n in parser.files if n.split('/')[-1].lower() == "super.img" and parser.files[n]['method'] == 0]
+        for name in supers:
+            if not self.missing(targets): break
+            try:
+                start = await parser.get_data_start(name)
+                extractor = await SuperExtractor.open(client, start, parser.files[name]['comp_size'])
+            except Exception:
+                continue
+            for lp_name, actual in extractor.names().items():
+                self._add(f"{prefix}{name}/{lp_name}.img", {"kind": "super", "extractor": extractor, "name": actual})
+
+    async def probe(self, client, parser, targets, limit=NESTED_PROBE_LIMIT):
+        await self._add_level("", client, parser, targets)
+        sem = asyncio.Semaphore(limit)
+        pending = set()
+
+        async def probe_one(prefix, client, parser, zip_name, data_start):
+            info = parser.files[zip_name]
+            async with sem:
+                if info['method'] == 8:
+                    sub_client = await InflatedFileClient.open(client, data_start, info['comp_size'], info['size'])
+                else:
+                    sub_client = SubFileClient(client, data_start, info['comp_size'])
+                sub_parser = ZipParser(sub_client)
+                await sub_parser.parse()
+                sub_prefix = f"{prefix}{zip_name}/"
+                await self._add_level(sub_prefix, sub_client, sub_parser, targets)
+                return sub_prefix, sub_client, sub_parser
+
+        async def schedule(prefix, client, parser):
+            files = parser.files
+            # Deflated inner zips need a full inflate pass to build their seek
+            # index, so they queue behind every stored one.
+            persists = client.get_index() is not None
+
+            def probed(f):
+                if files[f]['method'] == 0: return True
+                return files[f]['method'] == 8 and ZRAN_AVAILABLE and (persists or files[f]['comp_size'] <= NESTED_INFLATE_LIMIT)
+
+            nested = sorted(
+                (f for f in files if f.lower().endswith('.zip') and probed(f)),
+                key=lambda f: files[f]['method']
+            )
+            if not nested: return
+            starts = await parser.get_data_starts(nested)
+            for zip_name in nested:
+                pending.add(asyncio.ensure_future(probe_one(prefix, client, parser, zip_name, starts[zip_name])))
+
+        try:
+            if self.missing(targets):
+                await schedule("", client, parser)
+            while pending and self.missing(targets):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled() or task.exception(): continue
+                    if self.missing(targets):
+                        await schedule(*task.result())
+        finally:
+            for task in pending: task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def close(self):
+        for extractor in self._extractors:
+            extractor.close()
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+
+def cache_key(url, validator, size):
+    return hashlib.sha256(f"{url}\0{validator}\0{size}".encode()).hexdigest()[:32]
+
+def _atomic_write(directory, path, data):
+    # Write-then-rename keeps readers in other processes from ever seeing a
+    # partially written file.
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        try: os.unlink(tmp)
+        except OSError: pass
+
+class BlockCache:
+    def __init__(self, cache_dir, block_size=1024 * 1024, max_bytes=2 * 1024 ** 3, evict_every=64):
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._puts = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key, block):
+        return os.path.join(self.cache_dir, key, f"{block:08x}")
+
+    def get_many(self, key, blocks, expected):
+        found = {}
+        for b in blocks:
+            path = self._path(key, b)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                continue
+            if len(data) == expected(b):
+                found[b] = data
+        return found
+
+    def put_many(self, key, blocks):
+        d = os.path.join(self.cache_dir, key)
+        os.makedirs(d, exist_ok=True)
+        for b, data in blocks.items():
+            _atomic_write(d, self._path(key, b), data)
+        self._puts += len(blocks)
+        if self._puts >= self.evict_every:
+            self._puts = 0
+            self.evict()
+
+    def drop(self, key, blocks):
+        for b in blocks:
+            try: os.unlink(self._path(key, b))
+            except OSError: pass
+
+    def evict(self):
+        entries, total = [], 0
+        now = time.time()
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try: st = os.stat(path)
+                except OSError: continue
+                if name.startswith(".tmp-"):
+                    # Leftovers from a crashed writer.
+                    if now - st.st_mtime > 3600:
+                        try: os.unlink(path)
+                        except OSError: pass
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.max_bytes: return
+        entries.sort()
+        for _, size, path in entries:
+            try: os.unlink(path)
+            except OSError: continue
+            total -= size
+            if total <= self.max_bytes: break
+
+
+class ArchiveIndex:
+    SECTIONS = ("zips", "payloads", "deflate", "supers")
+
+    def __init__(self, **sections):
+        for name in self.SECTIONS:
+            setattr(self, name, sections.get(name) or {})
+        self.dirty = False
+
+    def to_bytes(self):
+        doc = {name: getattr(self, name) for name in self.SECTIONS}
+        return IndexCache.MAGIC + zlib.compress(json.dumps(doc, separators=(",", ":")).encode())
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data.startswith(IndexCache.MAGIC): raise ValueError("Not an fcetool index")
+        doc = json.loads(zlib.decompress(data[len(IndexCache.MAGIC):]))
+        return cls(**{name: doc.get(name) for name in cls.SECTIONS})
+
+
+class IndexCache:
+    MAGIC = b"FCEIDX5\n"
+
+    def __init__(self, cache_dir):
+        self.dir = os.path.join(cache_dir, "index")
+        os.makedirs(self.dir, exist_ok=True)
+
+    def load(self, key):
+        path = os.path.join(self.dir, key + ".idx")
+        try:
+            with open(path, "rb") as f:
+                index = ArchiveIndex.from_bytes(f.read())
+            os.utime(path)
+            return index
+        except (OSError, ValueError, zlib.error):
+            return ArchiveIndex()
+
+    def save(self, key, index):
+        _atomic_write(self.dir, os.path.join(self.dir, key + ".idx"), index.to_bytes())
+        index.dirty = False
+
+
+class MemoryIndexCache:
+    # Live indexes shared by every session of one process: a session opening
+    # an archive that another one is still reading starts from whatever that
+    # one has parsed so far, not from the last saved copy.
+    def __init__(self, cache_dir=None, max_entries=64):
+        self.backing = IndexCache(cache_dir) if cache_dir else None
+        self.max_entries = max_entries
+        self._indexes = OrderedDict()
+
+    def load(self, key):
+        index = self._indexes.get(key)
+        if index is None:
+            index = self.backing.load(key) if self.backing else ArchiveIndex()
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_entries: self._indexes.popitem(last=False)
+        self._indexes.move_to_end(key)
+        return index
+
+    def save(self, key, index):
+        self._indexes[key] = index
+        if self.backing: self.backing.save(key, index)
+        else: index.dirty = False
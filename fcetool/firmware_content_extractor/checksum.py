@@ -0,0 +1,63 @@
+import ctypes
+import zlib
+from .zran import _libz
+
+CRC32_POLY = 0xEDB88320
+
+def _load_combine():
+    fn = getattr(_libz, "crc32_combine64", None) or getattr(_libz, "crc32_combine", None)
+    if fn is None: return None
+    fn.argtypes = [ctypes.c_ulong, ctypes.c_ulong, ctypes.c_longlong if fn.__name__.endswith("64") else ctypes.c_long]
+    fn.restype = ctypes.c_ulong
+    return fn
+
+_combine = _load_combine() if _libz is not None else None
+
+def _gf2_times(mat, vec):
+    s, i = 0, 0
+    while vec:
+        if vec & 1: s ^= mat[i]
+        vec >>= 1
+        i += 1
+    return s
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, mat[n]) for n in range(32)]
+
+def crc32_combine(crc1, crc2, len2):
+    # CRC of A + B from crc(A), crc(B) and len(B), so chunks fetched and
+    # checked out of order still add up to the entry's CRC.
+    if len2 <= 0: return crc1
+    if _combine is not None: return _combine(crc1, crc2, len2) & 0xFFFFFFFF
+
+    # zlib's own fallback: apply len2 zero bytes to crc1 by repeated
+    # squaring of the one-zero-bit operator over GF(2).
+    odd = [CRC32_POLY] + [1 << n for n in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1: crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2: break
+        odd = _gf2_square(even)
+        if len2 & 1: crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2: break
+    return crc1 ^ crc2
+
+def combine_all(parts):
+    crc = 0
+    for part_crc, length in parts:
+        crc = crc32_combine(crc, part_crc, length)
+    return crc
+
+
+class RunningCrc:
+    def __init__(self, write):
+        self._write = write
+        self.crc = 0
+
+    def __call__(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self._write(data)
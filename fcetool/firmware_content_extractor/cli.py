@@ -3,121 +3,291 @@ import asyncio
 import os
 import sys
 import time
-from .network import NetworkManager, SubFileClient
-from .parser import ZipParser
+from .network import NetworkManager
+from .cache import BlockCache, IndexCache
+from .parser import open_parser
+from .local import LocalFileClient
+from .sinks import FileSink, StreamSink
 from .direct import DirectExtractor
-from .payload import PayloadExtractor
-from .fasturl import fasturl
-
-async def find_and_extract(client, parser, filename, out_path, p_name):
-
-    files = parser.files
-    real_file = next((f for f in files if f.split('/')[-1].lower() == filename.lower()), None)
-    
-    if real_file:
-        extractor = DirectExtractor(client, parser)
-        await extractor.extract(real_file, out_path)
-        return True
-
-    if "payload.bin" in files:
-        extractor = PayloadExtractor(client, parser)
-        try:
-            await extractor.extract(p_name, out_path)
-            return True
-        except Exception as e:
-            return False
-    
-    nested_zips = [
-        f for f in files 
-        if f.lower().endswith('.zip') and files[f]['method'] == 0
-    ]
-    
-    for zip_name in nested_zips:
-        data_start = await parser.get_data_start(zip_name)
-        data_size = files[zip_name]['comp_size']
-        sub_client = SubFileClient(client, data_start, data_size)
-        sub_parser = ZipParser(sub_client)
-        
+from .fasturl import fasturl, mirrors as mirror_urls
+from .archive import ArchiveTree
+from .concurrency import gather_or_cancel
+
+INVALID_URL = "Invalid URL: Please provide a valid URL starting with http:// or https://"
+INVALID_SOURCE = "Invalid URL: Please provide a valid URL starting with http:// or https://, or a local file path"
 
-        try:
-            await sub_parser.parse()
-            if await find_and_extract(sub_client, sub_parser, filename, out_path, p_name):
-                return True
-        except Exception as e:
-            continue
+def open_source(url, cache_dir=None, rtt=None, bandwidth=None, index_cache=None, allow_local=False, mirrors=False):
+    # Local paths are opt-in: a service passing on URLs from its clients
+    # must not let them read files off its own disk.
+    local_path = url[len("file://"):] if url.startswith("file://") else url
+    local = allow_local and os.path.isfile(local_path)
+    if not local and not url.startswith(('http://', 'https://')):
+        return None
 
-    return False
+    cache = BlockCache(cache_dir) if cache_dir and not local else None
+    if index_cache is None and cache_dir: index_cache = IndexCache(cache_dir)
+    if local:
+        return LocalFileClient(local_path, index_cache=index_cache)
+    # Striping across mirrors is opt-in: it opens connections to hosts the
+    # caller never named.
+    return NetworkManager(
+        fasturl(url), cache=cache, index_cache=index_cache, rtt=rtt, bandwidth=bandwidth,
+        mirrors=mirror_urls(url) if mirrors else None
+    )
 
-async def extract_async(url, filename, out_dir="."):
+async def identify(client, parser, targets):
+    # What each target is without extracting it: payload partitions carry
+    # their image's sha256 in the manifest, plain zip entries only a CRC.
+    tree = ArchiveTree()
+    found = {}
     try:
-        if not url.startswith(('http://', 'https://')):
-            return {
-                "success": False,
-                "error": "Invalid URL: Please provide a valid URL starting with http:// or https://"
-            }
-        url = fasturl(url)
+        await tree.probe(client, parser, targets)
+        for filename in targets:
+            entry = tree.find(filename)
+            if not entry: continue
+            if entry["kind"] == "payload":
+                manifest, _ = await entry["extractor"].load_manifest()
+                part = manifest.partitions[entry["name"]]
+                found[filename] = {"sha256": part.hash.hex() or None, "size": part.size}
+            elif entry["kind"] == "super":
+                found[filename] = {"sha256": None, "size": entry["extractor"].plan(entry["name"])["size"]}
+            else:
+                info = entry["parser"].files[entry["name"]]
+                found[filename] = {"sha256": None, "size": info["size"], "crc32": info.get("crc")}
+    finally:
+        tree.close()
+    return found
+
+async def find_and_extract(client, parser, targets, out_dir, memory_budget=None, dry_run=False, sinks=None, resume=True,
+                           sources=None):
+    # Payload images that cannot be streamed in order are staged next to the outputs.
+    tree = ArchiveTree(memory_budget, out_dir if os.path.isdir(out_dir) else None)
+    found = {}
+    try:
+        await tree.probe(client, parser, targets)
+
+        direct = []
+        logical = []
+        payload_jobs = {}
+        for filename in targets:
+            entry = tree.find(filename)
+            if not entry: continue
+            out_path = sinks[filename] if sinks and filename in sinks else FileSink(os.path.join(out_dir, filename), resume)
+            if entry["kind"] == "file":
+                direct.append((entry, filename, out_path))
+            elif entry["kind"] == "super":
+                logical.append((entry, filename, out_path))
+            else:
+                payload_jobs.setdefault(entry["extractor"], {})[entry["name"]] = (filename, out_path)
+
+        if dry_run:
+            for entry, filename, _ in direct:
+                info = entry["parser"].files[entry["name"]]
+                found[filename] = {"method": info["method"], "comp_size": info["comp_size"], "size": info["size"]}
+            for entry, filename, _ in logical:
+                found[filename] = entry["extractor"].plan(entry["name"])
+            for extractor, jobs in payload_jobs.items():
+                plan = await extractor.plan(list(jobs))
+                for filename, _ in jobs.values(): found[filename] = plan
+            return found
+
+        async def run_direct(entry, filename, out_path):
+            extractor = DirectExtractor(entry["client"], entry["parser"])
+            await extractor.extract(entry["name"], out_path)
+            found[filename] = out_path
+
+        async def run_super(entry, filename, out_path):
+            await entry["extractor"].extract(entry["name"], out_path)
+            found[filename] = out_path
+
+        async def run_payload(extractor, jobs):
+            await extractor.extract_many(
+                {p_name: out_path for p_name, (_, out_path) in jobs.items()},
+                {p_name: sources[filename] for p_name, (filename, _) in jobs.items() if sources and filename in sources}
+            )
+            found.update(dict(jobs.values()))
+
+        await gather_or_cancel(
+            *(run_direct(*job) for job in direct),
+            *(run_super(*job) for job in logical),
+            *(run_payload(ex, jobs) for ex, jobs in payload_jobs.items())
+        )
+    finally:
+        tree.close()
+
+    return found
+
+async def extract_async(url, filenames, out_dir=".", cache_dir=None, memory_budget=None,
+                        rtt=None, bandwidth=None, dry_run=False, sinks=None, resume=True, sources=None,
+                        index_cache=None, allow_local=False, mirrors=False):
+    single = isinstance(filenames, str)
+    targets = [filenames] if single else list(dict.fromkeys(filenames))
+    sinks = sinks or {}
+    try:
+        source = open_source(url, cache_dir, rtt, bandwidth, index_cache, allow_local, mirrors)
+        if source is None:
+            error = INVALID_SOURCE if allow_local else INVALID_URL
+            for sink in sinks.values(): sink.close(Exception(error))
+            return {"success": False, "error": error}
 
-        if not os.path.exists(out_dir):
+        if not dry_run and not os.path.exists(out_dir) and any(t not in sinks for t in targets):
             os.makedirs(out_dir)
-            
-        out_path = os.path.join(out_dir, filename)
-        p_name = filename.replace(".img", "")
         
-        async with NetworkManager(url) as client:
-            parser = ZipParser(client)
-            await parser.parse()
+        async with source as client:
+            parser = await open_parser(client)
             
-            success = await find_and_extract(client, parser, filename, out_path, p_name)
+            try:
+                found = await find_and_extract(
+                    client, parser, targets, out_dir, memory_budget, dry_run, sinks, resume, sources
+                )
+            finally:
+                client.save_index()
             
-            if success:
-                return {
-                    "success": True,
-                    "output_path": os.path.abspath(out_path),
-                    "filename": filename
-                }
-            else:
-                return {
-                    "success": False,
-                    "error": f"File '{filename}' not found in ROM (searched nested archives)"
-                }
+            results = []
+            for filename in targets:
+                if filename in found and dry_run:
+                    results.append({"success": True, "plan": found[filename], "filename": filename})
+                elif filename in found and isinstance(found[filename], FileSink):
+                    results.append({
+                        "success": True,
+                        "output_path": os.path.abspath(found[filename].path),
+                        "filename": filename
+                    })
+                elif filename in found:
+                    results.append({"success": True, "filename": filename})
+                else:
+                    error = f"File '{filename}' not found in ROM (searched nested archives)"
+                    if filename in sinks: sinks[filename].close(Exception(error))
+                    results.append({"success": False, "error": error, "filename": filename})
+
+            network = client.limiter.report()
+            network["corrupt_ranges"] = len(client.corrupt)
+            if len(getattr(client, "mirrors", ())) > 1: network["mirrors"] = client.mirror_report()
+            if single:
+                result = results[0]
+                if result["success"]:
+                    result["network"] = network
+                else:
+                    del result["filename"]
+                return result
+            return {
+                "success": all(r["success"] for r in results),
+                "results": results,
+                "network": network
+            }
                 
     except Exception as e:
         import traceback
         traceback.print_exc()
+        # Sinks already closed by their extractor tolerate a second close;
+        # the rest must not leave a reader waiting.
+        for sink in sinks.values(): sink.close(e)
         return {
             "success": False,
             "error": str(e)
         }
 
+async def identify_async(url, filenames, cache_dir=None, index_cache=None, allow_local=False, mirrors=False):
+    targets = list(dict.fromkeys([filenames] if isinstance(filenames, str) else filenames))
+    try:
+        source = open_source(url, cache_dir, index_cache=index_cache, allow_local=allow_local, mirrors=mirrors)
+        if source is None:
+            return {"success": False, "error": INVALID_SOURCE if allow_local else INVALID_URL}
+        async with source as client:
+            parser = await open_parser(client)
+            try:
+                found = await identify(client, parser, targets)
+            finally:
+                client.save_index()
+        results = [
+            dict(found[f], success=True, filename=f) if f in found
+            else {"success": False, "error": f"File '{f}' not found in ROM (searched nested archives)", "filename": f}
+            for f in targets
+        ]
+        return {"success": all(r["success"] for r in results), "results": results}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
 def main():
     parser = argparse.ArgumentParser(
         description="Firmware Content Extractor"
     )
-    parser.add_argument("url", help="URL of the ROM/ZIP")
-    parser.add_argument("filename", help="Target filename to extract")
+    parser.add_argument("url", help="URL or local path of the ROM/ZIP or payload.bin")
+    parser.add_argument("filenames", nargs="+", help="Target filename(s) to extract")
     parser.add_argument(
-        "output_dir",
-        nargs="?",
-        default=".",
-        help="Output directory (default: current directory '.')"
+        "-o", "--output-dir",
+        default=None,
+        help="Output directory (default: current directory '.'), or '-' to stream a single file to stdout"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory for a persistent range cache shared across runs"
+    )
+    parser.add_argument("--rtt", type=float, default=None, help="Round-trip time in seconds (measured if omitted)")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Per-connection bandwidth in MB/s (measured if omitted)")
+    parser.add_argument("--plan", action="store_true", help="Print the fetch plan without extracting")
+    parser.add_argument("--no-resume", action="store_true", help="Ignore progress journals left by an interrupted run")
+    parser.add_argument("--mirrors", action="store_true", help="Spread downloads across every known mirror of the URL's host")
+    parser.add_argument(
+        "--source", action="append", default=[], metavar="[FILENAME=]PATH",
+        help="Base image an incremental OTA is applied to (FILENAME= is needed with several targets)"
     )
 
     args = parser.parse_args()
 
+    # Backwards compatible form: `fcetool URL boot.img OUT_DIR`.
+    if args.output_dir is None:
+        args.output_dir = "."
+        last = args.filenames[-1]
+        if len(args.filenames) > 1 and (os.path.isdir(last) or not os.path.splitext(last)[1]):
+            args.output_dir = args.filenames.pop()
+
+    sources = {}
+    for spec in args.source:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            if len(args.filenames) != 1: parser.error("--source needs FILENAME=PATH with several filenames")
+            name, path = args.filenames[0], spec
+        sources[name] = path
+
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-    print(f"\n[INFO] Extracting '{args.filename}' from '{args.url}' into '{args.output_dir}'")
+    sinks = None
+    log = sys.stdout
+    if args.output_dir == "-":
+        if len(args.filenames) != 1: parser.error("streaming to stdout takes exactly one filename")
+        sinks = {args.filenames[0]: StreamSink(sys.stdout.buffer)}
+        log = sys.stderr
+
+    print(f"\n[INFO] Extracting '{', '.join(args.filenames)}' from '{args.url}' into '{args.output_dir}'", file=log)
 
     start_time = time.perf_counter()
 
-    result = asyncio.run(extract_async(args.url, args.filename, args.output_dir))
+    bandwidth = args.bandwidth * 1024 * 1024 if args.bandwidth else None
+    result = asyncio.run(extract_async(
+        args.url, args.filenames, args.output_dir, args.cache_dir,
+        rtt=args.rtt, bandwidth=bandwidth, dry_run=args.plan, sinks=sinks,
+        resume=not args.no_resume, sources=sources, allow_local=True, mirrors=args.mirrors
+    ))
     elapsed = time.perf_counter() - start_time
 
-    if result.get("success"):
-        print(f"\n[OK] output: {args.filename} ({elapsed:.2f}s)\n")
-    else:
-        print(f"\n[FAIL] {result.get('error')} ({elapsed:.2f}s)\n")
+    if "results" not in result:
+        print(f"\n[FAIL] {result.get('error')} ({elapsed:.2f}s)\n", file=log)
+        return
+
+    print(file=log)
+    for r in result["results"]:
+        if r["success"] and args.plan:
+            print(f"[PLAN] {r['filename']}", file=log)
+            for key, value in r["plan"].items():
+                if key != "groups": print(f"    {key}: {value}", file=log)
+        elif r["success"]:
+            print(f"[OK] output: {r['filename']}", file=log)
+        else:
+            print(f"[FAIL] {r['error']}", file=log)
+    print(f"\n({elapsed:.2f}s, concurrency {result['network']['concurrency']})\n", file=log)
 
 if __name__ == "__main__":
     main()
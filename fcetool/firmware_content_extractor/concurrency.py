@@ -0,0 +1,229 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+THROTTLE_STATUSES = (429, 503)
+RETRY_BASE = 0.5
+RETRY_CAP = 8.0
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 16
+HEDGE_BUDGET = 0.1
+LATENCY_WINDOW = 256
+
+def backoff_delay(attempt, base=RETRY_BASE, cap=RETRY_CAP):
+    # Full jitter: retries of requests that failed together spread out
+    # instead of hitting a struggling server again in lockstep.
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def _quantile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def gather_or_cancel(*aws):
+    # Like gather, but the first failure also stops the siblings instead of
+    # leaving them running against outputs that are about to be closed.
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def write_ordered(client, write, jobs, window):
+    # Pieces are fetched a few ahead but handed to write strictly in order,
+    # on an executor thread, for sinks that can only be appended to.
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    jobs = iter(jobs)
+    try:
+        while True:
+            while len(pending) < min(client.concurrency, window):
+                job = next(jobs, None)
+                if job is None: break
+                pending.append(asyncio.ensure_future(job))
+            if not pending: break
+            data = await pending.popleft()
+            await loop.run_in_executor(None, write, data)
+    finally:
+        for task in pending: task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def run_pieces(client, count, work, journal):
+    # work(k) for every piece the journal does not have yet, with what it
+    # returns marked in the journal; the journal is flushed however the
+    # run ends, so a rerun skips the pieces already written.
+    sem = asyncio.Semaphore(client.concurrency)
+    done = journal.done if journal else {}
+
+    async def worker(k):
+        async with sem:
+            value = await work(k)
+            if journal: journal.mark(k, value)
+
+    try:
+        await gather_or_cancel(*(worker(k) for k in range(count) if k not in done))
+    finally:
+        if journal: journal.flush()
+
+class LatencyTracker:
+    # Recent response times, split into time to headers and body rate so a
+    # deadline can be given for a request of any size.
+    def __init__(self, percentile=HEDGE_PERCENTILE, window=LATENCY_WINDOW):
+        self.percentile = percentile
+        self.ttfb = deque(maxlen=window)
+        self.rates = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def add(self, ttfb, body_rate=None):
+        self.ttfb.append(ttfb)
+        if body_rate is not None: self.rates.append(body_rate)
+
+    def deadline(self, nbytes):
+        self.requests += 1
+        if len(self.ttfb) < HEDGE_MIN_SAMPLES: return None
+        t = _quantile(self.ttfb, self.percentile)
+        if nbytes and self.rates: t += nbytes / _quantile(self.rates, 1 - self.percentile)
+        return t
+
+    def may_hedge(self):
+        # Capped so a server that is slow for everyone does not get every
+        # request twice.
+        return self.hedged < HEDGE_BUDGET * self.requests
+
+
+class AdaptiveConcurrency:
+    def __init__(self, initial=8, minimum=2, maximum=64, backoff=0.5, tolerance=0.8, min_sample=65536):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.min_sample = min_sample
+        self.in_flight = 0
+        self.peak = 0
+        self.rate = None
+        self.best_rate = 0.0
+        self.rtt = None
+        self.body_rate = None
+        self.latency = LatencyTracker()
+        self.errors = 0
+        self.throttled = 0
+        self._last_backoff = 0.0
+        self._slow_start = True
+        self._cond = asyncio.Condition()
+
+    @classmethod
+    def fixed(cls, concurrency):
+        return cls(initial=concurrency, minimum=concurrency, maximum=concurrency)
+
+    @property
+    def settled(self):
+        return int(self.limit)
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        sample = {"bytes": 0, "status": None, "headers": None}
+        t0 = time.perf_counter()
+        try:
+            yield sample
+        except Exception:
+            self._on_failure(sample["status"])
+            raise
+        else:
+            ttfb = sample["headers"] - t0 if sample["headers"] else None
+            self._on_success(sample["bytes"], time.perf_counter() - t0, ttfb)
+        finally:
+            async with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def _on_success(self, nbytes, elapsed, ttfb=None):
+        if ttfb is not None:
+            # Time to response headers stands in for the round trip; the
+            # body time that follows it gives the per-connection bandwidth.
+            self.rtt = ttfb if self.rtt is None else 0.8 * self.rtt + 0.2 * ttfb
+            body = None
+            if nbytes >= self.min_sample:
+                body = nbytes / max(elapsed - ttfb, 1e-6)
+                self.body_rate = body if self.body_rate is None else 0.8 * self.body_rate + 0.2 * body
+            self.latency.add(ttfb, body)
+        if nbytes < self.min_sample: return
+        rate = nbytes / max(elapsed, 1e-6)
+        self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+        self.best_rate = max(self.best_rate, self.rate)
+
+        if self.rate < self.tolerance * self.best_rate:
+            self._slow_start = False
+            return
+        if self.in_flight >= int(self.limit):
+            step = 1.0 if self._slow_start else 1.0 / self.limit
+            self.limit = min(self.maximum, self.limit + step)
+
+    def _on_failure(self, status):
+        if status in THROTTLE_STATUSES: self.throttled += 1
+        else: self.errors += 1
+
+        # One multiplicative decrease per burst: requests that were already in
+        # flight when the first failure hit should not halve the limit again.
+        now = time.perf_counter()
+        if now - self._last_backoff < 1.0: return
+        self._last_backoff = now
+        self._slow_start = False
+        self.limit = max(self.minimum, self.limit * self.backoff)
+        self.best_rate = self.rate or 0.0
+
+    def report(self):
+        return {
+            "concurrency": self.settled,
+            "peak_in_flight": self.peak,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "hedged": self.latency.hedged,
+            "hedge_wins": self.latency.hedge_wins,
+        }
+
+
+class ByteBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, nbytes):
+        async with self._cond:
+            # A single reservation larger than the budget is let through
+            # once nothing else is held, instead of waiting forever.
+            await self._cond.wait_for(lambda: self.used == 0 or self.used + nbytes <= self.limit)
+            self._take(nbytes)
+
+    def try_acquire(self, nbytes):
+        if self.used and self.used + nbytes > self.limit: return False
+        self._take(nbytes)
+        return True
+
+    def _take(self, nbytes):
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+
+    async def release(self, nbytes):
+        async with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def reserve(self, nbytes):
+        await self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            await self.release(nbytes)
@@ -0,0 +1,115 @@
+import bz2
+import hashlib
+import mmap
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+REPLACE, REPLACE_BZ, MOVE, BSDIFF, SOURCE_COPY, SOURCE_BSDIFF, ZERO, DISCARD, REPLACE_XZ, PUFFDIFF, \
+    BROTLI_BSDIFF, ZUCCHINI, LZ4DIFF_BSDIFF, LZ4DIFF_PUFFDIFF, REPLACE_ZSTD = range(15)
+
+OP_NAMES = {
+    MOVE: "MOVE", BSDIFF: "BSDIFF", PUFFDIFF: "PUFFDIFF", ZUCCHINI: "ZUCCHINI",
+    LZ4DIFF_BSDIFF: "LZ4DIFF_BSDIFF", LZ4DIFF_PUFFDIFF: "LZ4DIFF_PUFFDIFF",
+}
+SOURCE_OPS = (SOURCE_COPY, SOURCE_BSDIFF, BROTLI_BSDIFF)
+SUPPORTED_OPS = (REPLACE, REPLACE_BZ, ZERO, DISCARD, REPLACE_XZ, REPLACE_ZSTD) + SOURCE_OPS
+
+def unsupported_ops(part):
+    return sorted({OP_NAMES.get(t, str(t)) for t in set(part.types) if t not in SUPPORTED_OPS})
+
+def needs_source(part):
+    return any(t in SOURCE_OPS for t in set(part.types))
+
+
+class SourceImage:
+    # The partition an incremental payload was built against, read through
+    # a read-only map like a local ROM.
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._fd = os.open(self.path, os.O_RDONLY)
+        st = os.fstat(self._fd)
+        self.size = st.st_size
+        self.key = f"{st.st_size}-{st.st_mtime_ns}"
+        self.verified = False
+        self._mm = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ) if self.size else None
+        self._view = memoryview(self._mm) if self._mm is not None else memoryview(b"")
+
+    def read(self, extents, bs):
+        spans = [self._view[sb * bs : (sb + nb) * bs] for sb, nb in extents]
+        if any(len(s) != nb * bs for s, (_, nb) in zip(spans, extents)):
+            raise Exception(f"Source image {self.path} is smaller than the update expects")
+        return spans[0] if len(spans) == 1 else b"".join(spans)
+
+    def sha256(self, size):
+        h = hashlib.sha256()
+        for off in range(0, min(size, self.size), 1 << 20):
+            h.update(self._view[off : min(off + (1 << 20), size)])
+        return h.digest()
+
+    def close(self):
+        self._view.release()
+        if self._mm is not None:
+            try: self._mm.close()
+            except BufferError: pass
+        os.close(self._fd)
+
+
+def _offtin(buf, pos):
+    # bsdiff integers: little endian magnitude with the sign in the top bit.
+    v = int.from_bytes(buf[pos : pos + 8], "little")
+    return -(v & ((1 << 63) - 1)) if v >> 63 else v
+
+def _decompress(kind, data):
+    if kind == 0: return data
+    if kind == 1: return bz2.decompress(data)
+    if kind == 2:
+        if brotli is None: raise Exception("Brotli patches need the 'brotli' package")
+        return brotli.decompress(bytes(data))
+    raise Exception(f"Unknown bsdiff compressor {kind}")
+
+def _add_bytes(a, b):
+    # Bytewise a + b mod 256 on whole runs at once: the low seven bits of
+    # every byte are added in parallel, the top bits fixed up with xor.
+    n = len(a)
+    if not n: return b""
+    low, high = int.from_bytes(b"\x7f" * n, "little"), int.from_bytes(b"\x80" * n, "little")
+    x, y = int.from_bytes(a, "little"), int.from_bytes(b, "little")
+    return (((x & low) + (y & low)) ^ ((x ^ y) & high)).to_bytes(n, "little")
+
+def bspatch(old, patch):
+    # Both the classic BSDIFF40 layout (bzip2 everywhere) and Android's
+    # BSDF2, which names a compressor per stream.
+    patch = memoryview(patch)
+    magic = bytes(patch[:8])
+    if magic == b"BSDIFF40": kinds = (1, 1, 1)
+    elif magic[:5] == b"BSDF2": kinds = tuple(magic[5:8])
+    else: raise Exception("Unknown bsdiff patch format")
+    ctrl_len, diff_len, new_size = _offtin(patch, 8), _offtin(patch, 16), _offtin(patch, 24)
+    if min(ctrl_len, diff_len, new_size) < 0: raise Exception("Corrupt bsdiff header")
+    ctrl = _decompress(kinds[0], patch[32 : 32 + ctrl_len])
+    diff = _decompress(kinds[1], patch[32 + ctrl_len : 32 + ctrl_len + diff_len])
+    extra = _decompress(kinds[2], patch[32 + ctrl_len + diff_len :])
+
+    old = memoryview(old)
+    new = bytearray(new_size)
+    new_pos = old_pos = d_pos = e_pos = 0
+    for c in range(0, len(ctrl) - 23, 24):
+        x, y, z = _offtin(ctrl, c), _offtin(ctrl, c + 8), _offtin(ctrl, c + 16)
+        if x < 0 or y < 0 or new_pos + x + y > new_size: raise Exception("Corrupt bsdiff patch")
+
+        seg = bytearray(diff[d_pos : d_pos + x])
+        # Bytes of old outside its bounds count as zero.
+        lo, hi = max(old_pos, 0), min(old_pos + x, len(old))
+        if hi > lo: seg[lo - old_pos : hi - old_pos] = _add_bytes(seg[lo - old_pos : hi - old_pos], old[lo:hi])
+        new[new_pos : new_pos + x] = seg
+        new_pos, old_pos, d_pos = new_pos + x, old_pos + x, d_pos + x
+
+        new[new_pos : new_pos + y] = extra[e_pos : e_pos + y]
+        new_pos, e_pos = new_pos + y, e_pos + y
+        old_pos += z
+    if new_pos != new_size: raise Exception("Corrupt bsdiff patch")
+    return new
@@ -1,77 +1,168 @@
 import zlib
-import os
-import mmap
 import asyncio
+from .checksum import RunningCrc, combine_all
+from .concurrency import run_pieces, write_ordered
+from .journal import open_journal
+from .sinks import as_sink, closing_sink
+from .zran import (
+    ZRAN_AVAILABLE, build_deflate_index, inflate_segment,
+    load_deflate_index, store_deflate_index, stream_inflate,
+)
+
+CHUNK_SIZE = 4 * 1024 * 1024
+STREAM_WINDOW = 8
+SEQUENTIAL_RETRIES = 1
+VERIFY_RETRIES = 2
 
 class DirectExtractor:
     def __init__(self, client, parser):
         self.client = client
         self.parser = parser
 
-    async def extract(self, filename, output_path):
+    async def extract(self, filename, output):
         file_info = self.parser.files[filename]
         start_pos = await self.parser.get_data_start(filename)
         file_size = file_info['comp_size']
-        
-        if file_info['method'] == 8:
-            await self._extract_sequential_compressed(start_pos, file_size, output_path)
-        else:
-            await self._extract_parallel(start_pos, file_size, output_path)
-
-    async def _extract_sequential_compressed(self, start_pos, file_size, output_path):
-        end_pos = start_pos + file_size
-        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
-        
-        with open(output_path, 'wb') as f:
-            cur = start_pos
-            while cur < end_pos:
-                chunk_size = min(4 * 1024 * 1024, end_pos - cur)
-                data = await self.client.fetch_range(cur, cur + chunk_size)
-                f.write(decompressor.decompress(data))
-                cur += chunk_size
-            f.write(decompressor.flush())
-
-    async def _extract_parallel(self, start_pos, file_size, output_path):
-        with open(output_path, "wb") as f:
-            f.truncate(file_size)
-
-        if file_size == 0:
-            return
+        # Passed down rather than kept on self, so one extractor can run
+        # several extractions at once.
+        entry = (filename, start_pos, file_size, file_info.get('crc'))
 
-        fd = os.open(output_path, os.O_RDWR)
-        
-        try:
-            mm = mmap.mmap(fd, file_size)
-        except Exception:
-            os.close(fd)
-            await self._extract_sequential_raw(start_pos, file_size, output_path)
-            return
+        with closing_sink(as_sink(output)) as sink:
+            if file_info['method'] == 8:
+                key = f"{self.client.origin}/{start_pos}"
+                dindex = load_deflate_index(self.client, key)
+                if dindex:
+                    await self._extract_parallel_compressed(entry, dindex, sink)
+                else:
+                    await self._extract_sequential_compressed(entry, file_info.get('size'), key, sink)
+            else:
+                await self._extract_parallel(entry, sink)
 
-        chunk_size = 4 * 1024 * 1024
-        tasks = []
+    def _check_crc(self, entry, crc):
+        filename, start_pos, file_size, expected = entry
+        if expected is None or crc == expected: return True
+        self.client.report_corrupt(start_pos, start_pos + file_size)
+        return False
+
+    async def _repair(self, entry, pieces, crcs, fetch, mm):
+        # Only the entry's overall CRC is known, so a mismatch is localised
+        # by reading every piece once more: pieces whose CRC changed were
+        # the corrupt ones, and only those are rewritten.
+        loop = asyncio.get_running_loop()
+        if self._check_crc(entry, combine_all(zip(crcs, (n for _, n in pieces)))): return
         sem = asyncio.Semaphore(self.client.concurrency)
 
-        async def worker(file_offset, url_offset, size):
+        async def recheck(k):
+            o_start, o_len = pieces[k]
             async with sem:
-                data = await self.client.fetch_range(url_offset, url_offset + size)
-                mm[file_offset : file_offset + size] = data
-
-        for i in range(0, file_size, chunk_size):
-            size = min(chunk_size, file_size - i)
-            tasks.append(worker(i, start_pos + i, size))
-
-        try:
-            await asyncio.gather(*tasks)
-        finally:
-            mm.close()
-            os.close(fd)
-
-    async def _extract_sequential_raw(self, start_pos, file_size, output_path):
-        end_pos = start_pos + file_size
-        with open(output_path, 'wb') as f:
-            cur = start_pos
-            while cur < end_pos:
-                chunk_size = min(4 * 1024 * 1024, end_pos - cur)
-                data = await self.client.fetch_range(cur, cur + chunk_size)
-                f.write(data)
-                cur += chunk_size
+                data = await fetch(k)
+                crc = await loop.run_in_executor(None, zlib.crc32, data)
+                if crc != crcs[k]:
+                    mm[o_start : o_start + o_len] = data
+                    crcs[k] = crc
+
+        await asyncio.gather(*(recheck(k) for k in range(len(pieces))))
+        if not self._check_crc(entry, combine_all(zip(crcs, (n for _, n in pieces)))):
+            raise Exception(f"CRC mismatch in {entry[0]}")
+
+    async def _write_ordered(self, entry, sink, jobs):
+        out = RunningCrc(sink.write)
+        await write_ordered(self.client, out, jobs, STREAM_WINDOW)
+        # Already handed to the sink, so there is nothing left to retry.
+        if not self._check_crc(entry, out.crc): raise Exception(f"CRC mismatch in {entry[0]}")
+
+    async def _extract_sequential_compressed(self, entry, out_size, key, sink):
+        _, start_pos, file_size, _ = entry
+        # Without checkpoints the stream can only be checked as a whole, so
+        # a sink that can be rewritten gets another full pass on a mismatch.
+        attempts = 1 + SEQUENTIAL_RETRIES if sink.random_access else 1
+        for attempt in range(attempts):
+            sink.open(out_size or 0)
+            out = RunningCrc(sink.write)
+            dindex = None
+            try:
+                if ZRAN_AVAILABLE and out_size is not None and self.client.get_index() is not None:
+                    dindex = await build_deflate_index(self.client, start_pos, file_size, out_size, out)
+                else:
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    await stream_inflate(self.client, start_pos, file_size, decompressor, out)
+            except zlib.error:
+                self.client.report_corrupt(start_pos, start_pos + file_size)
+                if attempt == attempts - 1: raise
+                continue
+            if self._check_crc(entry, out.crc):
+                if dindex: store_deflate_index(self.client, key, dindex)
+                return
+        raise Exception(f"CRC mismatch in {entry[0]}")
+
+    async def _extract_parallel_compressed(self, entry, dindex, sink):
+        start_pos = entry[1]
+        loop = asyncio.get_running_loop()
+
+        async def segment(k):
+            c_start, c_end, _, o_len = dindex.segment(k)
+            for attempt in range(VERIFY_RETRIES + 1):
+                data = await self.client.fetch_range(start_pos + c_start, start_pos + c_end)
+                try:
+                    return await loop.run_in_executor(None, inflate_segment, data, dindex.points[k], o_len)
+                except Exception:
+                    # Corrupt input rarely inflates cleanly; refetch just
+                    # this segment.
+                    self.client.report_corrupt(start_pos + c_start, start_pos + c_end)
+                    if attempt == VERIFY_RETRIES: raise
+
+        if not sink.random_access:
+            sink.open(dindex.size)
+            await self._write_ordered(entry, sink, (segment(k) for k in range(len(dindex.points))))
+            return
+
+        pieces = [dindex.segment(k)[2:] for k in range(len(dindex.points))]
+        journal = open_journal(self.client, sink, f"{start_pos}z/{len(pieces)}", dindex.size)
+        mm = sink.map(dindex.size, keep=bool(journal and journal.done))
+        if dindex.size == 0:
+            return
+        await self._run_pieces(entry, pieces, segment, mm, journal)
+
+    async def _run_pieces(self, entry, pieces, fetch, mm, journal):
+        loop = asyncio.get_running_loop()
+        done = journal.done if journal else {}
+        crcs = [done.get(k, 0) for k in range(len(pieces))]
+
+        async def work(k):
+            o_start, o_len = pieces[k]
+            data = await fetch(k)
+            mm[o_start : o_start + o_len] = data
+            crcs[k] = await loop.run_in_executor(None, zlib.crc32, data)
+            return crcs[k]
+
+        await run_pieces(self.client, len(pieces), work, journal)
+        await self._repair(entry, pieces, crcs, fetch, mm)
+        if journal: journal.finish()
+
+    async def _extract_parallel(self, entry, sink):
+        _, start_pos, file_size, _ = entry
+        chunks = [(i, min(CHUNK_SIZE, file_size - i)) for i in range(0, file_size, CHUNK_SIZE)]
+
+        mm = journal = None
+        if sink.random_access:
+            journal = open_journal(self.client, sink, f"{start_pos}/{CHUNK_SIZE}", file_size)
+            try:
+                mm = sink.map(file_size, keep=bool(journal and journal.done))
+            except Exception:
+                mm = None
+        if mm is None:
+            await self._extract_sequential_raw(entry, chunks, sink)
+            return
+
+        async def fetch(k):
+            file_offset, size = chunks[k]
+            return await self.client.fetch_range(start_pos + file_offset, start_pos + file_offset + size)
+
+        await self._run_pieces(entry, chunks, fetch, mm, journal)
+
+    async def _extract_sequential_raw(self, entry, chunks, sink):
+        start_pos = entry[1]
+        sink.open(sum(size for _, size in chunks))
+        await self._write_ordered(
+            entry, sink, (self.client.fetch_range(start_pos + i, start_pos + i + size) for i, size in chunks)
+        )
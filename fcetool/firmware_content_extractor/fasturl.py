@@ -1,3 +1,5 @@
+from urllib.parse import urlsplit
+
 xiaomi = {
     "fast_domain": "bkt-sgp-miui-ota-update-alisgp.oss-ap-southeast-1.aliyuncs.com",
     "original_domains": [
@@ -20,4 +22,15 @@ def fasturl(url):
             if original in url:
                 return url.replace(original, config["fast_domain"])
     
-    return url  # ما تغير → رجّع الأصلي
\ No newline at end of file
+    return url  # ما تغير → رجّع الأصلي
+
+
+def mirrors(url):
+    # Every host of the matching company serving the same path, fastest
+    # first. Hosts are compared whole: one original is a suffix of another.
+    host = urlsplit(url).hostname
+    for company, config in COMPANY_DOMAINS.items():
+        domains = [config["fast_domain"]] + config["original_domains"]
+        if host in domains:
+            return [url.replace(host, domain, 1) for domain in domains]
+    return [url]
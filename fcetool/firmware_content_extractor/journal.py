@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import time
+from .cache import _atomic_write
+
+JOURNAL_SUFFIX = ".fcejournal"
+FLUSH_INTERVAL = 1.0
+
+class Journal:
+    # Sidecar of an output file listing the units (chunks, segments, ops)
+    # already written to it, so a rerun fetches only the rest. Units are
+    # only recorded once their data is in the shared mapping, which the OS
+    # keeps even if the process dies.
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.done = {}
+        self._dirty = False
+        self._flushed = time.monotonic()
+
+    @classmethod
+    def open(cls, output_path, key, size):
+        journal = cls(output_path + JOURNAL_SUFFIX, key)
+        try:
+            with open(journal.path) as f:
+                doc = json.load(f)
+            if doc["key"] == key and os.path.getsize(output_path) == size:
+                journal.done = {int(k): v for k, v in doc["done"].items()}
+        except (OSError, ValueError, KeyError):
+            pass
+        return journal
+
+    def mark(self, unit, value=True):
+        self.done[unit] = value
+        self._dirty = True
+        if time.monotonic() - self._flushed >= FLUSH_INTERVAL: self.flush()
+
+    def flush(self):
+        if not self._dirty: return
+        data = json.dumps({"key": self.key, "done": self.done}, separators=(",", ":")).encode()
+        _atomic_write(os.path.dirname(os.path.abspath(self.path)), self.path, data)
+        self._dirty = False
+        self._flushed = time.monotonic()
+
+    def finish(self):
+        self.done = {}
+        self._dirty = False
+        try: os.unlink(self.path)
+        except OSError: pass
+
+
+def open_journal(client, sink, target, size):
+    # Only files that outlive the run can be resumed, and only from a
+    # source whose identity (ETag / Last-Modified / mtime) is known.
+    if not getattr(sink, "resume", False): return None
+    source = client.source_key()
+    if source is None: return None
+    key = hashlib.sha256(f"{source}\0{client.origin}\0{target}\0{size}".encode()).hexdigest()
+    return Journal.open(sink.path, key, size)
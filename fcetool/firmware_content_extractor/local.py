@@ -0,0 +1,77 @@
+import mmap
+import os
+from .concurrency import AdaptiveConcurrency
+from .cache import cache_key
+
+LOCAL_CONCURRENCY = 16
+LOCAL_RTT = 0.0001
+LOCAL_BANDWIDTH = 1024 ** 3
+
+class LocalFileClient:
+    def __init__(self, path, concurrency=LOCAL_CONCURRENCY, index_cache=None):
+        self.path = os.path.abspath(path)
+        self.index_cache = index_cache
+        self.index = None
+        self.origin = ""
+        self.limiter = AdaptiveConcurrency.fixed(concurrency)
+        self.concurrency = concurrency
+        self.file_size = 0
+        self.validator = None
+        self.corrupt = []
+        self._fd = None
+        self._mm = None
+        self._view = None
+
+    async def __aenter__(self):
+        self._fd = os.open(self.path, os.O_RDONLY)
+        st = os.fstat(self._fd)
+        self.file_size = st.st_size
+        self.validator = f"{st.st_mtime_ns}"
+        if self.file_size:
+            self._mm = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mm)
+        else:
+            self._view = memoryview(b"")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._view.release()
+        if self._mm is not None:
+            try: self._mm.close()
+            except BufferError:
+                # Slices handed out are still alive; the map is unmapped
+                # once they are collected.
+                pass
+        os.close(self._fd)
+
+    async def get_size(self):
+        return self.file_size
+
+    def link(self):
+        return {"rtt": LOCAL_RTT, "bandwidth": LOCAL_BANDWIDTH, "concurrency": self.concurrency, "multi_range": True}
+
+    def source_key(self):
+        return cache_key(self.path, self.validator, self.file_size)
+
+    def report_corrupt(self, start, end):
+        self.corrupt.append((start, end))
+
+    def get_index(self):
+        if self.index is None and self.index_cache is not None:
+            self.index = self.index_cache.load(cache_key(self.path, self.validator, self.file_size))
+        return self.index
+
+    def save_index(self):
+        if self.index is not None and self.index.dirty:
+            self.index_cache.save(cache_key(self.path, self.validator, self.file_size), self.index)
+
+    async def fetch_range(self, start, end):
+        # Slices of the map, not copies: pages are read in by whoever
+        # consumes them, usually an executor thread writing the output.
+        return self._view[max(start, 0) : min(end, self.file_size)]
+
+    async def fetch_ranges(self, ranges):
+        return [self._view[max(s, 0) : min(e, self.file_size)] for s, e in ranges]
+
+    async def fetch_tail(self, length):
+        return bytes(self._view[max(self.file_size - length, 0):])
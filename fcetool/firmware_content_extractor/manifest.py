@@ -0,0 +1,206 @@
+import array
+from base64 import b64decode, b64encode
+
+NO_DIGEST = bytes(32)
+
+def read_varint(data, pos):
+    b = data[pos]
+    if b < 0x80: return b, pos + 1
+    res, shift = b & 0x7F, 7
+    pos += 1
+    while True:
+        b = data[pos]
+        pos += 1
+        res |= (b & 0x7F) << shift
+        if b < 0x80: return res, pos
+        shift += 7
+
+def skip_field(data, pos, wt):
+    if wt == 0: return read_varint(data, pos)[1]
+    if wt == 2:
+        l, pos = read_varint(data, pos)
+        return pos + l
+    if wt == 1: return pos + 8
+    if wt == 5: return pos + 4
+    raise Exception(f"Unsupported protobuf wire type {wt}")
+
+
+class Partition:
+    COLUMNS = {
+        "types": "B",
+        "offsets": "Q",
+        "lengths": "Q",
+        "ext_index": "I",
+        "ext_start": "Q",
+        "ext_blocks": "Q",
+        "data_sha256": "B",
+        "src_index": "I",
+        "src_start": "Q",
+        "src_blocks": "Q",
+        "src_sha256": "B",
+    }
+
+    def __init__(self, name=None):
+        self.name = name
+        self.size = 0
+        self.hash = b""
+        self.old_size = 0
+        self.old_hash = b""
+        for col, code in self.COLUMNS.items():
+            setattr(self, col, array.array(code))
+        self.ext_index.append(0)
+        self.src_index.append(0)
+
+    def __len__(self):
+        return len(self.types)
+
+    def extents(self, i):
+        a, b = self.ext_index[i], self.ext_index[i + 1]
+        return zip(self.ext_start[a:b], self.ext_blocks[a:b])
+
+    def src_extents(self, i):
+        a, b = self.src_index[i], self.src_index[i + 1]
+        return zip(self.src_start[a:b], self.src_blocks[a:b])
+
+    def digest(self, i):
+        # All zeros when the op carries no data hash.
+        d = self.data_sha256[32 * i : 32 * i + 32].tobytes()
+        return d if d != NO_DIGEST else None
+
+    def src_digest(self, i):
+        d = self.src_sha256[32 * i : 32 * i + 32].tobytes()
+        return d if d != NO_DIGEST else None
+
+    def output_blocks(self):
+        return max((s + n for s, n in zip(self.ext_start, self.ext_blocks)), default=0)
+
+    @staticmethod
+    def _parse_info(data, pos, end):
+        size, digest = 0, b""
+        while pos < end:
+            tag, pos = read_varint(data, pos)
+            fn, wt = tag >> 3, tag & 7
+            if fn == 1: size, pos = read_varint(data, pos)
+            elif fn == 2:
+                l, pos = read_varint(data, pos)
+                digest = bytes(data[pos:pos + l])
+                pos += l
+            else: pos = skip_field(data, pos, wt)
+        return size, digest
+
+    @staticmethod
+    def _parse_extent(data, pos, end, starts, blocks):
+        sb = nb = 0
+        while pos < end:
+            etag, pos = read_varint(data, pos)
+            if etag == 0x08: sb, pos = read_varint(data, pos)
+            elif etag == 0x10: nb, pos = read_varint(data, pos)
+            else: pos = skip_field(data, pos, etag & 7)
+        starts.append(sb)
+        blocks.append(nb)
+
+    def _parse_op(self, data, pos, end):
+        t = off = ln = 0
+        digest = src_digest = NO_DIGEST
+        while pos < end:
+            tag, pos = read_varint(data, pos)
+            fn = tag >> 3
+            if fn == 1: t, pos = read_varint(data, pos)
+            elif fn == 2: off, pos = read_varint(data, pos)
+            elif fn == 3: ln, pos = read_varint(data, pos)
+            elif fn in (4, 6):
+                l, pos = read_varint(data, pos)
+                if fn == 4: self._parse_extent(data, pos, pos + l, self.src_start, self.src_blocks)
+                else: self._parse_extent(data, pos, pos + l, self.ext_start, self.ext_blocks)
+                pos += l
+            elif fn in (8, 9) and tag & 7 == 2:
+                l, pos = read_varint(data, pos)
+                if l == 32 and fn == 8: digest = data[pos:pos + l]
+                elif l == 32: src_digest = data[pos:pos + l]
+                pos += l
+            else: pos = skip_field(data, pos, tag & 7)
+        self.types.append(t)
+        self.offsets.append(off)
+        self.lengths.append(ln)
+        self.data_sha256.frombytes(digest)
+        self.src_sha256.frombytes(src_digest)
+        self.ext_index.append(len(self.ext_start))
+        self.src_index.append(len(self.src_start))
+
+    @classmethod
+    def parse(cls, data, pos, end):
+        part = cls()
+        while pos < end:
+            tag, pos = read_varint(data, pos)
+            fn, wt = tag >> 3, tag & 7
+            if wt != 2 or fn not in (1, 6, 7, 8):
+                pos = skip_field(data, pos, wt)
+                continue
+            l, pos = read_varint(data, pos)
+            if fn == 1: part.name = bytes(data[pos:pos + l]).decode()
+            elif fn == 6: part.old_size, part.old_hash = part._parse_info(data, pos, pos + l)
+            elif fn == 7: part.size, part.hash = part._parse_info(data, pos, pos + l)
+            else: part._parse_op(data, pos, pos + l)
+            pos += l
+        return part
+
+    def to_dict(self):
+        doc = {
+            "name": self.name, "size": self.size, "hash": self.hash.hex(),
+            "old_size": self.old_size, "old_hash": self.old_hash.hex(),
+        }
+        for col in self.COLUMNS:
+            doc[col] = b64encode(getattr(self, col).tobytes()).decode()
+        return doc
+
+    @classmethod
+    def from_dict(cls, doc):
+        part = cls(doc["name"])
+        part.size = doc["size"]
+        part.hash = bytes.fromhex(doc["hash"])
+        part.old_size = doc["old_size"]
+        part.old_hash = bytes.fromhex(doc["old_hash"])
+        for col, code in cls.COLUMNS.items():
+            arr = array.array(code)
+            arr.frombytes(b64decode(doc[col]))
+            setattr(part, col, arr)
+        return part
+
+
+class Manifest:
+    def __init__(self):
+        self.block_size = 4096
+        self.partitions = {}
+
+    @classmethod
+    def parse(cls, data):
+        manifest = cls()
+        pos, end = 0, len(data)
+        while pos < end:
+            tag, pos = read_varint(data, pos)
+            fn, wt = tag >> 3, tag & 7
+            if fn == 3 and wt == 0:
+                manifest.block_size, pos = read_varint(data, pos)
+            elif fn == 13 and wt == 2:
+                l, pos = read_varint(data, pos)
+                part = Partition.parse(data, pos, pos + l)
+                manifest.partitions[part.name] = part
+                pos += l
+            else:
+                pos = skip_field(data, pos, wt)
+        return manifest
+
+    def to_dict(self):
+        return {
+            "block_size": self.block_size,
+            "partitions": [p.to_dict() for p in self.partitions.values()],
+        }
+
+    @classmethod
+    def from_dict(cls, doc):
+        manifest = cls()
+        manifest.block_size = doc["block_size"]
+        for p in doc["partitions"]:
+            part = Partition.from_dict(p)
+            manifest.partitions[part.name] = part
+        return manifest
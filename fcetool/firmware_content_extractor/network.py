@@ -1,13 +1,60 @@
 import aiohttp
 import asyncio
+import random
+import time
+from urllib.parse import urlsplit
+from .concurrency import AdaptiveConcurrency, backoff_delay
+from .cache import cache_key
+
+MAX_RANGES_PER_REQUEST = 32
+MIRROR_PROBE_TIMEOUT = 10
+MIRROR_MAX_FAILURES = 2
+MIRROR_MIN_SAMPLES = 4
+MIRROR_SLOW_FRACTION = 0.25
+MIRROR_MIN_SAMPLE = 65536
+
+def parse_content_range(value):
+    unit, _, spec = value.strip().partition(" ")
+    span, _, total = spec.partition("/")
+    start, _, end = span.partition("-")
+    total = int(total) if total and total != "*" else None
+    return int(start), int(end), total
+
+class Mirror:
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.rate = None
+        self.samples = 0
+        self.failures = 0
+        self.bytes = 0
+
+    def record(self, nbytes, elapsed):
+        if nbytes < MIRROR_MIN_SAMPLE: return
+        rate = nbytes / max(elapsed, 1e-6)
+        self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+        self.samples += 1
+
 
 class NetworkManager:
-    def __init__(self, url, concurrency=16):
+    def __init__(self, url, concurrency=None, cache=None, index_cache=None, rtt=None, bandwidth=None, mirrors=None):
         self.url = url
-        self.concurrency = concurrency
+        self.mirrors = [Mirror(url)] + [Mirror(u) for u in dict.fromkeys(mirrors or []) if u != url]
+        self._probe = None
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.cache = cache
+        self.index_cache = index_cache
+        self.index = None
+        self.origin = ""
+        self.validator = None
+        self.limiter = AdaptiveConcurrency() if concurrency is None else AdaptiveConcurrency.fixed(concurrency)
+        self.concurrency = self.limiter.maximum
         self.connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=3000, force_close=False, ssl=False)
         self.session = None
         self.file_size = 0
+        self.multi_range = True
+        self.corrupt = []
 
     async def __aenter__(self):
         self.session = aiohttp.ClientSession(
@@ -25,32 +72,349 @@ class NetworkManager:
             await self.session.close()
 
     async def get_size(self):
+        if self.file_size:
+            return self.file_size
         try:
             async with self.session.head(self.url) as resp:
                 if resp.status == 200:
                     self.file_size = int(resp.headers.get("Content-Length", 0))
+                    self.validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
                     return self.file_size
             
             async with self.session.get(self.url, headers={"Range": "bytes=0-0"}) as resp:
                 if resp.status in [200, 206]:
                     val = resp.headers.get("Content-Range", "").split("/")
                     self.file_size = int(val[1]) if len(val) > 1 else int(resp.headers.get("Content-Length", 0))
+                    self.validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
                     return self.file_size
                 raise Exception(f"HTTP {resp.status}")
         except Exception as e:
             raise Exception(f"Connection Failed: {e}")
 
+    async def fetch_tail(self, length, retries=3):
+        headers = {"Range": f"bytes=-{length}"}
+        for attempt in range(retries):
+            try:
+                async with self.limiter.slot() as sample:
+                    async with self.session.get(self.url, headers=headers) as resp:
+                        sample["status"] = resp.status
+                        sample["headers"] = time.perf_counter()
+                        if resp.status not in [200, 206]:
+                            raise Exception(f"HTTP {resp.status}")
+                        total = None
+                        if resp.status == 206:
+                            total = parse_content_range(resp.headers.get("Content-Range", ""))[2]
+                        if total is None:
+                            # Suffix ranges unsupported: drop the body and
+                            # fall back to HEAD + explicit range below.
+                            break
+                        self.file_size = total
+                        self.validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+                        data = await resp.read()
+                        sample["bytes"] = len(data)
+                        return data
+            except Exception:
+                if attempt == retries - 1: raise
+                await asyncio.sleep(backoff_delay(attempt))
+
+        size = await self.get_size()
+        n = min(length, size)
+        return await self.fetch_range(size - n, size)
+
+    def link(self):
+        return {
+            "rtt": self.rtt or self.limiter.rtt,
+            "bandwidth": self.bandwidth or self.limiter.body_rate,
+            "concurrency": self.limiter.settled,
+            "multi_range": self.multi_range,
+        }
+
+    def get_index(self):
+        if self.index is None and self.index_cache is not None and self.validator and self.file_size:
+            self.index = self.index_cache.load(cache_key(self.url, self.validator, self.file_size))
+        return self.index
+
+    def save_index(self):
+        if self.index is not None and self.index.dirty:
+            self.index_cache.save(cache_key(self.url, self.validator, self.file_size), self.index)
+
+    def mirror_report(self):
+        return {
+            urlsplit(m.url).netloc: {"healthy": m.healthy, "bytes": m.bytes, "rate": m.rate}
+            for m in self.mirrors
+        }
+
+    async def _ensure_mirrors(self):
+        if len(self.mirrors) == 1: return
+        if self._probe is None: self._probe = asyncio.ensure_future(self._probe_mirrors())
+        await asyncio.shield(self._probe)
+
+    async def _probe_mirrors(self):
+        # A mirror is only trusted with ranges if it serves the very same
+        # file: same size and same ETag / Last-Modified as the primary.
+        await self.get_size()
+        timeout = aiohttp.ClientTimeout(total=MIRROR_PROBE_TIMEOUT)
+
+        async def probe(mirror):
+            try:
+                async with self.session.head(mirror.url, allow_redirects=True, timeout=timeout) as resp:
+                    tag = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+                    size = int(resp.headers.get("Content-Length", -1))
+                    mirror.healthy = resp.status == 200 and size == self.file_size and tag == self.validator
+            except Exception:
+                mirror.healthy = False
+
+        if self.validator is None:
+            for mirror in self.mirrors[1:]: mirror.healthy = False
+            return
+        await asyncio.gather(*(probe(m) for m in self.mirrors[1:]))
+
+    def _pick(self):
+        # Weighted by measured throughput; mirrors without a measurement yet
+        # get the best rate seen so they are tried.
+        live = [m for m in self.mirrors if m.healthy]
+        best = max((m.rate for m in live if m.rate), default=1.0)
+        return random.choices(live, weights=[m.rate or best for m in live])[0]
+
+    def _mirror_done(self, mirror, nbytes, elapsed):
+        mirror.failures = 0
+        mirror.bytes += nbytes
+        mirror.record(nbytes, elapsed)
+        live = [m for m in self.mirrors if m.healthy and m.samples >= MIRROR_MIN_SAMPLES]
+        if len(live) > 1 and mirror in live:
+            if mirror.rate < MIRROR_SLOW_FRACTION * max(m.rate for m in live): self._drop(mirror)
+
+    def _mirror_failed(self, mirror):
+        mirror.failures += 1
+        if mirror.failures >= MIRROR_MAX_FAILURES: self._drop(mirror)
+
+    def _drop(self, mirror):
+        if sum(m.healthy for m in self.mirrors) > 1: mirror.healthy = False
+
+    async def _mirror_get(self, headers, nbytes, sample, read):
+        # One GET against a mirror picked for this request, with its outcome
+        # fed back into the mirror's standing.
+        mirror = self._pick() if len(self.mirrors) > 1 else self.mirrors[0]
+        t0 = time.perf_counter()
+        try:
+            async with self.session.get(mirror.url, headers=headers) as resp:
+                sample["status"] = resp.status
+                sample["headers"] = time.perf_counter()
+                result = await read(resp)
+        except asyncio.CancelledError:
+            # Never a rate sample, as nothing was delivered. Cancelled past
+            # the usual latency for its size it was a hedge loser, and
+            # counts against the mirror like a failure.
+            deadline = self.limiter.latency.deadline(nbytes)
+            if deadline is not None and time.perf_counter() - t0 > deadline: self._mirror_failed(mirror)
+            raise
+        except Exception:
+            self._mirror_failed(mirror)
+            raise
+        self._mirror_done(mirror, sample["bytes"], time.perf_counter() - t0)
+        return result
+
+    def source_key(self):
+        if not self.validator: return None
+        return cache_key(self.url, self.validator, self.file_size)
+
+    def report_corrupt(self, start, end):
+        # Data failed a checksum: forget any cached copy so the retry goes
+        # back to the server.
+        self.corrupt.append((start, end))
+        if self._cacheable() and end > start:
+            bs = self.cache.block_size
+            key = cache_key(self.url, self.validator, self.file_size)
+            self.cache.drop(key, range(start // bs, (end - 1) // bs + 1))
+
+    def _check_validator(self, resp):
+        if self.cache and self.validator:
+            current = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+            if current and current != self.validator:
+                raise Exception("Remote file changed during extraction")
+
+    def _cacheable(self):
+        return self.cache is not None and self.validator is not None and self.file_size > 0
+
     async def fetch_range(self, start, end, retries=3):
+        if self._cacheable():
+            return (await self._fetch_cached([(start, end)], retries))[0]
+        return await self._fetch_range(start, end, retries)
+
+    async def fetch_ranges(self, ranges, retries=3):
+        if self._cacheable():
+            return await self._fetch_cached(list(ranges), retries)
+        return await self._fetch_ranges(ranges, retries)
+
+    async def _fetch_cached(self, ranges, retries):
+        bs = self.cache.block_size
+        key = cache_key(self.url, self.validator, self.file_size)
+        expected = lambda b: min(bs, self.file_size - b * bs)
+        needed = sorted({b for s, e in ranges if e > s for b in range(s // bs, (e - 1) // bs + 1)})
+
+        loop = asyncio.get_running_loop()
+        blocks = await loop.run_in_executor(None, self.cache.get_many, key, needed, expected)
+
+        runs = []
+        for b in needed:
+            if b in blocks: continue
+            if runs and runs[-1][1] == b - 1: runs[-1][1] = b
+            else: runs.append([b, b])
+
+        if runs:
+            spans = [(first * bs, min((last + 1) * bs, self.file_size)) for first, last in runs]
+            fetched = {}
+            for (first, last), data in zip(runs, await self._fetch_ranges(spans, retries)):
+                for b in range(first, last + 1):
+                    fetched[b] = data[(b - first) * bs : (b - first + 1) * bs]
+            blocks.update(fetched)
+            await loop.run_in_executor(None, self.cache.put_many, key, fetched)
+
+        out = []
+        for s, e in ranges:
+            if e <= s:
+                out.append(b"")
+                continue
+            first = s // bs
+            joined = b"".join(blocks[b] for b in range(first, (e - 1) // bs + 1))
+            out.append(joined[s - first * bs : e - first * bs])
+        return out
+
+    async def _fetch_range(self, start, end, retries=3):
         headers = {"Range": f"bytes={start}-{end-1}"}
+        return await self._retry(lambda started: self._get_range(headers, end - start, started), end - start, retries)
+
+    async def _get_range(self, headers, nbytes, started):
+        async def read(resp):
+            if resp.status not in [200, 206]:
+                raise Exception(f"HTTP {resp.status}")
+            self._check_validator(resp)
+            data = await resp.read()
+            sample["bytes"] = len(data)
+            return data
+
+        async with self.limiter.slot() as sample:
+            started.set()
+            return await self._mirror_get(headers, nbytes, sample, read)
+
+    async def _retry(self, request, nbytes, retries):
+        await self._ensure_mirrors()
         for attempt in range(retries):
             try:
-                async with self.session.get(self.url, headers=headers) as resp:
-                    if resp.status not in [200, 206]:
-                        raise Exception(f"HTTP {resp.status}")
-                    return await resp.read()
+                return await self._hedged(request, nbytes)
             except Exception:
                 if attempt == retries - 1: raise
-                await asyncio.sleep(1)
+                await asyncio.sleep(backoff_delay(attempt))
+
+    async def _hedged(self, request, nbytes):
+        # A request still running past the session's usual latency for its
+        # size gets a duplicate; the first answer wins and the other is
+        # cancelled. The clock starts once the request holds a slot, so
+        # queueing behind the limiter does not count as slowness.
+        latency = self.limiter.latency
+        started = asyncio.Event()
+        first = asyncio.ensure_future(request(started))
+        tasks = {first}
+        waiter = asyncio.ensure_future(started.wait())
+        try:
+            await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            deadline = None if first.done() else latency.deadline(nbytes)
+            if deadline is not None:
+                await asyncio.wait(tasks, timeout=deadline)
+                if not first.done() and latency.may_hedge():
+                    latency.hedged += 1
+                    tasks.add(asyncio.ensure_future(request(asyncio.Event())))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first: latency.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            waiter.cancel()
+            for task in tasks: task.cancel()
+
+    async def _fetch_ranges(self, ranges, retries=3):
+        ranges = list(ranges)
+        results = [None] * len(ranges)
+        if len(ranges) > 1 and self.multi_range:
+            for i in range(0, len(ranges), MAX_RANGES_PER_REQUEST):
+                group = ranges[i:i + MAX_RANGES_PER_REQUEST]
+                results[i:i + len(group)] = await self._fetch_multi(group, retries)
+                if not self.multi_range: break
+
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            data = await asyncio.gather(*(self._fetch_range(*ranges[i], retries) for i in missing))
+            for i, d in zip(missing, data): results[i] = d
+        return results
+
+    async def _fetch_multi(self, ranges, retries):
+        spec = ",".join(f"{s}-{e-1}" for s, e in ranges)
+        headers = {"Range": f"bytes={spec}"}
+        nbytes = sum(e - s for s, e in ranges)
+        return await self._retry(lambda started: self._get_multi(ranges, headers, nbytes, started), nbytes, retries)
+
+    async def _get_multi(self, ranges, headers, nbytes, started):
+        async def read(resp):
+            if resp.status == 200:
+                self.multi_range = False
+                return [None] * len(ranges)
+            if resp.status != 206:
+                raise Exception(f"HTTP {resp.status}")
+            self._check_validator(resp)
+
+            ctype = resp.headers.get("Content-Type", "")
+            if ctype.lower().startswith("multipart/byteranges"):
+                boundary = ctype.split("boundary=", 1)[1].strip().strip('"')
+                parts = await self._read_multipart(resp.content, boundary)
+            else:
+                p_start = parse_content_range(resp.headers.get("Content-Range", ""))[0]
+                parts = [(p_start, await resp.read())]
+            sample["bytes"] = sum(len(d) for _, d in parts)
+            return self._slice_parts(parts, ranges)
+
+        async with self.limiter.slot() as sample:
+            started.set()
+            return await self._mirror_get(headers, nbytes, sample, read)
+
+    @staticmethod
+    async def _read_multipart(stream, boundary):
+        delim = b"--" + boundary.encode()
+        parts = []
+        while True:
+            line = await stream.readline()
+            if not line: break
+            line = line.strip()
+            if not line: continue
+            if line == delim + b"--": break
+            if line != delim: raise Exception("Malformed multipart/byteranges response")
+
+            p_start = p_end = None
+            while True:
+                h = (await stream.readline()).strip()
+                if not h: break
+                key, _, val = h.decode("latin-1").partition(":")
+                if key.strip().lower() == "content-range":
+                    p_start, p_end, _ = parse_content_range(val)
+            if p_start is None: raise Exception("Multipart part without Content-Range")
+            parts.append((p_start, await stream.readexactly(p_end - p_start + 1)))
+        return parts
+
+    @staticmethod
+    def _slice_parts(parts, ranges):
+        out = []
+        for s, e in ranges:
+            hit = None
+            for p_start, data in parts:
+                if p_start <= s and e <= p_start + len(data):
+                    hit = data[s - p_start : e - p_start]
+                    break
+            out.append(hit)
+        return out
 
 
 class SubFileClient:
@@ -58,13 +422,34 @@ class SubFileClient:
         self.parent = parent_client
         self.offset = offset
         self.size = size
+        self.origin = f"{parent_client.origin}/{offset}"
         self.concurrency = parent_client.concurrency
 
     async def get_size(self):
         return self.size
 
+    def get_index(self):
+        return self.parent.get_index()
+
+    def link(self):
+        return self.parent.link()
+
+    def report_corrupt(self, start, end):
+        self.parent.report_corrupt(self.offset + start, self.offset + end)
+
+    def source_key(self):
+        return self.parent.source_key()
+
     async def fetch_range(self, start, end):
         real_start = self.offset + start
         real_end = self.offset + end
         return await self.parent.fetch_range(real_start, real_end)
 
+    async def fetch_ranges(self, ranges):
+        return await self.parent.fetch_ranges(
+            [(self.offset + s, self.offset + e) for s, e in ranges]
+        )
+
+    async def fetch_tail(self, length):
+        n = min(length, self.size)
+        return await self.fetch_range(self.size - n, self.size)
@@ -1,14 +1,35 @@
 import struct
 
+PAYLOAD_MAGIC = b"CrAU"
+
+async def open_parser(client):
+    parser = ZipParser(client)
+    try:
+        await parser.parse()
+    except Exception as e:
+        if str(e) != "Invalid ZIP format": raise
+        if bytes(await client.fetch_range(0, 4)) != PAYLOAD_MAGIC: raise
+        parser = PayloadFileParser(client)
+        await parser.parse()
+    return parser
+
 class ZipParser:
     def __init__(self, client):
         self.client = client
         self.files = {}
+        self.starts = {}
+        self.index = None
 
     async def parse(self):
+        tail = bytes(await self.client.fetch_tail(65536))
         file_size = await self.client.get_size()
-        read_size = min(65536, file_size)
-        tail = await self.client.fetch_range(file_size - read_size, file_size)
+        tail_start = file_size - len(tail)
+
+        self.index = self.client.get_index()
+        entry = self.index.zips.get(self.client.origin) if self.index is not None else None
+        if entry:
+            self.files, self.starts = entry["files"], entry["starts"]
+            return self.files
         
         eocd_pos = tail.rfind(b"PK\x05\x06")
         if eocd_pos == -1: raise Exception("Invalid ZIP format")
@@ -21,11 +42,17 @@ class ZipParser:
             zip64_loc = tail.rfind(b"PK\x06\x07")
             if zip64_loc != -1:
                 end64_pos = struct.unpack("<Q", tail[zip64_loc+8:zip64_loc+16])[0]
-                end64_data = await self.client.fetch_range(end64_pos, end64_pos + 56)
+                if end64_pos >= tail_start:
+                    end64_data = tail[end64_pos - tail_start : end64_pos - tail_start + 56]
+                else:
+                    end64_data = await self.client.fetch_range(end64_pos, end64_pos + 56)
                 cd_size = struct.unpack("<Q", end64_data[40:48])[0]
                 cd_offset = struct.unpack("<Q", end64_data[48:56])[0]
 
-        cd_data = await self.client.fetch_range(cd_offset, cd_offset + cd_size)
+        if cd_offset >= tail_start:
+            cd_data = tail[cd_offset - tail_start : cd_offset - tail_start + cd_size]
+        else:
+            cd_data = await self.client.fetch_range(cd_offset, cd_offset + cd_size)
         
         pos = 0
         while pos < len(cd_data):
@@ -37,32 +64,85 @@ class ZipParser:
             comment_len = struct.unpack("<H", header[32:34])[0]
             lh_offset = struct.unpack("<I", header[42:46])[0]
             c_size = struct.unpack("<I", header[20:24])[0]
+            u_size = struct.unpack("<I", header[24:28])[0]
+            crc = struct.unpack("<I", header[16:20])[0]
             
-            fname = cd_data[pos+46:pos+46+name_len].decode('utf-8', 'ignore')
+            fname = bytes(cd_data[pos+46:pos+46+name_len]).decode('utf-8', 'ignore')
             
-            if lh_offset == 0xFFFFFFFF:
+            if 0xFFFFFFFF in (lh_offset, c_size, u_size):
                 extra = cd_data[pos+46+name_len : pos+46+name_len+extra_len]
                 p = 0
-                while p < len(extra):
+                while p + 4 <= len(extra):
                     hid, dsize = struct.unpack("<HH", extra[p:p+4])
                     if hid == 1:
-                        if lh_offset == 0xFFFFFFFF and len(extra[p+4:p+4+dsize]) >= 8:
-                            lh_offset = struct.unpack("<Q", extra[p+4+dsize-8:p+4+dsize])[0]
+                        # Zip64 fields appear in this fixed order, each only
+                        # when the 32-bit field above is saturated.
+                        q, q_end = p + 4, p + 4 + dsize
+                        if u_size == 0xFFFFFFFF and q + 8 <= q_end:
+                            u_size = struct.unpack("<Q", extra[q:q+8])[0]
+                            q += 8
+                        if c_size == 0xFFFFFFFF and q + 8 <= q_end:
+                            c_size = struct.unpack("<Q", extra[q:q+8])[0]
+                            q += 8
+                        if lh_offset == 0xFFFFFFFF and q + 8 <= q_end:
+                            lh_offset = struct.unpack("<Q", extra[q:q+8])[0]
                         break
                     p += 4 + dsize
 
             self.files[fname] = {
                 "method": method, 
                 "comp_size": c_size, 
-                "lh_offset": lh_offset
+                "size": u_size,
+                "lh_offset": lh_offset,
+                "crc": crc
             }
             pos += 46 + name_len + extra_len + comment_len
+
+        if self.index is not None:
+            self.index.zips[self.client.origin] = {"files": self.files, "starts": self.starts}
+            self.index.dirty = True
         return self.files
 
+    def _record_start(self, fname, start):
+        self.starts[fname] = start
+        if self.index is not None: self.index.dirty = True
+
     async def get_data_start(self, fname):
+        if fname in self.starts: return self.starts[fname]
         info = self.files[fname]
         off = info['lh_offset']
         head = await self.client.fetch_range(off, off + 256)
         n_len = struct.unpack("<H", head[26:28])[0]
         x_len = struct.unpack("<H", head[28:30])[0]
-        return off + 30 + n_len + x_len
+        self._record_start(fname, off + 30 + n_len + x_len)
+        return self.starts[fname]
+
+    async def get_data_starts(self, fnames):
+        todo = [f for f in fnames if f not in self.starts]
+        offs = [self.files[f]['lh_offset'] for f in todo]
+        heads = await self.client.fetch_ranges([(off, off + 256) for off in offs]) if todo else []
+        for fname, off, head in zip(todo, offs, heads):
+            n_len = struct.unpack("<H", head[26:28])[0]
+            x_len = struct.unpack("<H", head[28:30])[0]
+            self._record_start(fname, off + 30 + n_len + x_len)
+        return {f: self.starts[f] for f in fnames}
+
+
+class PayloadFileParser:
+    # A bare payload.bin, presented as an archive holding just that entry.
+    def __init__(self, client):
+        self.client = client
+        self.files = {}
+        self.starts = {}
+
+    async def parse(self):
+        size = await self.client.get_size()
+        self.files = {"payload.bin": {"method": 0, "comp_size": size, "size": size, "lh_offset": 0}}
+        self.starts = {"payload.bin": 0}
+        return self.files
+
+    async def get_data_start(self, fname):
+        return self.starts[fname]
+
+    async def get_data_starts(self, fnames):
+        return {f: self.starts[f] for f in fnames}
@@ -2,158 +2,399 @@ import struct
 import bz2
 import lzma
 import zstandard as zstd
-import mmap
 import os
 import asyncio
+import hashlib
+import mmap
+import tempfile
+from collections import deque
+from contextlib import ExitStack
 from concurrent.futures import ThreadPoolExecutor
+from .concurrency import ByteBudget, gather_or_cancel
+from .delta import (
+    BROTLI_BSDIFF, REPLACE_BZ, REPLACE_XZ, REPLACE_ZSTD, SOURCE_BSDIFF, SOURCE_COPY, SOURCE_OPS,
+    SourceImage, bspatch, needs_source, unsupported_ops,
+)
+from .journal import open_journal
+from .manifest import Manifest
+from .planner import BatchPlanner
+from .sinks import HashingSink, MmapSink, as_sink, closing_sink, write_zeros
+
+OUTPUT_PIECE = 1024 * 1024
+OP_OUTPUT_COST = 2 * OUTPUT_PIECE
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+VERIFY_RETRIES = 2
 
 class PayloadExtractor:
-    def __init__(self, client, parser):
+    def __init__(self, client, parser, memory_budget=None, planner=None, temp_dir=None):
         self.client = client
         self.parser = parser
-        self.executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        self.planner = planner
+        self.temp_dir = temp_dir
+        self.workers = os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.budget = ByteBudget(memory_budget or DEFAULT_MEMORY_BUDGET)
+        self._manifest = None
+
+    def close(self):
+        # The executor serves every extract_many call on this payload, so
+        # it lives until the archive is done with.
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def _decompress_stream(data, type_):
+        if type_ == 14:
+            yield from zstd.ZstdDecompressor().read_to_iter(data, write_size=OUTPUT_PIECE)
+            return
+        d = bz2.BZ2Decompressor() if type_ == 1 else lzma.LZMADecompressor()
+        yield d.decompress(data, OUTPUT_PIECE)
+        while not d.eof and not d.needs_input:
+            yield d.decompress(b"", OUTPUT_PIECE)
+
+    @staticmethod
+    def _old(src, part, i, bs):
+        if part.types[i] not in SOURCE_OPS: return None
+        old = src.read(list(part.src_extents(i)), bs)
+        digest = part.src_digest(i)
+        if digest and not src.verified and hashlib.sha256(old).digest() != digest:
+            raise Exception(f"Source image does not match {part.name} (op {i})")
+        return old
+
+    def _op_pieces(self, data, part, i, bs, src):
+        type_ = part.types[i]
+        if type_ in (REPLACE_BZ, REPLACE_XZ, REPLACE_ZSTD): return self._decompress_stream(data, type_)
+        if type_ == SOURCE_COPY: return [self._old(src, part, i, bs)]
+        if type_ in (SOURCE_BSDIFF, BROTLI_BSDIFF): return [bspatch(self._old(src, part, i, bs), data)]
+        return [data]
+
+    def _apply_op(self, data, part, i, mm, bs, src=None):
+        extents = list(part.extents(i))
+        pieces = self._op_pieces(data, part, i, bs, src)
+        if isinstance(pieces, list) and len(extents) == 1:
+            off = extents[0][0] * bs
+            n = min(len(pieces[0]), extents[0][1] * bs)
+            mm[off : off + n] = pieces[0][:n]
+            return
+
+        # Pieces are copied straight into their destination extents, so no
+        # whole-op output buffer is ever materialised.
+        spans = iter([(sb * bs, nb * bs) for sb, nb in extents])
+        off, size = next(spans, (0, 0))
+        for piece in pieces:
+            mv = memoryview(piece)
+            while len(mv) and size:
+                n = min(size, len(mv))
+                mm[off : off + n] = mv[:n]
+                mv = mv[n:]
+                off += n
+                size -= n
+                if not size:
+                    off, size = next(spans, (0, 0))
 
     @staticmethod
-    def _read_varint(data, pos):
-        res, shift = 0, 0
-        while True:
-            b = data[pos]
-            pos += 1
-            res |= (b & 0x7F) << shift
-            if not (b & 0x80): return res, pos
-            shift += 7
-
-    def _parse_manifest(self, data, target):
-        pos, end = 0, len(data)
-        while pos < end:
-            tag, pos = self._read_varint(data, pos)
-            if (tag >> 3) == 13:
-                length, pos = self._read_varint(data, pos)
-                p_end = pos + length
-                name = None
-                ops = []
-                cur = pos
-                while cur < p_end:
-                    ptag, cur = self._read_varint(data, cur)
-                    pfield = ptag >> 3
-                    if pfield == 1:
-                        slen, cur = self._read_varint(data, cur)
-                        name = data[cur:cur+slen].decode()
-                        cur += slen
-                    elif pfield == 8:
-                        olen, cur = self._read_varint(data, cur)
-                        ops.append(data[cur:cur+olen])
-                        cur += olen
-                    else:
-                        wt = ptag & 7
-                        if wt == 2:
-                            slen, cur = self._read_varint(data, cur)
-                            cur += slen
-                        elif wt == 0:
-                            _, cur = self._read_varint(data, cur)
-                
-                if name == target:
-                    return [self._parse_op(op) for op in ops]
-                pos = p_end
-            else:
-                wt = tag & 7
-                if wt == 2:
-                    l, pos = self._read_varint(data, pos)
-                    pos += l
-                elif wt == 0:
-                    _, pos = self._read_varint(data, pos)
-        return None
-
-    def _parse_op(self, buf):
-        pos, end = 0, len(buf)
-        op = {'t': 0, 'off': 0, 'len': 0, 'dst': []}
-        while pos < end:
-            tag, pos = self._read_varint(buf, pos)
-            fn = tag >> 3
-            if fn == 1: op['t'], pos = self._read_varint(buf, pos)
-            elif fn == 2: op['off'], pos = self._read_varint(buf, pos)
-            elif fn == 3: op['len'], pos = self._read_varint(buf, pos)
-            elif fn == 6:
-                l, pos = self._read_varint(buf, pos)
-                e_end = pos + l
-                sb, nb = 0, 0
-                while pos < e_end:
-                    etag, pos = self._read_varint(buf, pos)
-                    if (etag >> 3) == 1: sb, pos = self._read_varint(buf, pos)
-                    elif (etag >> 3) == 2: nb, pos = self._read_varint(buf, pos)
-                op['dst'].append((sb, nb))
-            else:
-                wt = tag & 7
-                if wt == 2:
-                    l, pos = self._read_varint(buf, pos)
-                    pos += l
-                elif wt == 0:
-                    _, pos = self._read_varint(buf, pos)
-        return op
-
-    def _decompress(self, data, type_):
-        if type_ == 1: return bz2.decompress(data)
-        elif type_ == 8: return lzma.decompress(data)
-        elif type_ == 14: return zstd.ZstdDecompressor().decompress(data)
-        return data
-
-    async def extract(self, partition, out_path):
+    def _check(data, digest):
+        return hashlib.sha256(data).digest() == digest
+
+    async def _verified(self, part, i, data, base_off):
+        # A bad op is refetched on its own; everything else already fetched
+        # with it is kept.
+        digest = part.digest(i)
+        if digest is None: return data
+        loop = asyncio.get_running_loop()
+        start = base_off + part.offsets[i]
+        end = start + part.lengths[i]
+        for _ in range(VERIFY_RETRIES):
+            if await loop.run_in_executor(self.executor, self._check, data, digest): return data
+            self.client.report_corrupt(start, end)
+            data = await self.client.fetch_range(start, end)
+        if await loop.run_in_executor(self.executor, self._check, data, digest): return data
+        raise Exception(f"Payload data for {part.name} (op {i}) failed sha256 verification")
+
+    async def load_manifest(self):
+        if self._manifest is not None: return self._manifest
         if "payload.bin" not in self.parser.files: raise Exception("payload.bin missing")
         
-        info = self.parser.files["payload.bin"]
         offset = await self.parser.get_data_start("payload.bin")
         
-        header = await self.client.fetch_range(offset, offset + 30)
-        m_size = struct.unpack(">Q", header[12:20])[0]
-        ms_size = struct.unpack(">I", header[20:24])[0]
-        
-        m_data = await self.client.fetch_range(offset+24, offset+24+m_size)
-        ops = self._parse_manifest(m_data, partition)
-        if not ops: raise Exception(f"Partition {partition} not found")
-        
-        base_off = offset + 24 + m_size + ms_size
-        max_sz = max(((s+n)*4096 for op in ops for s,n in op['dst']), default=0)
-        
-        with open(out_path, "wb") as f: f.truncate(max_sz)
-        fd = os.open(out_path, os.O_RDWR)
-        mm = mmap.mmap(fd, max_sz)
-        
-        ops.sort(key=lambda x: x['off'])
-        batches = []
-        c_batch, b_start, b_end = [], -1, -1
+        index = self.client.get_index()
+        key = f"{self.client.origin}/{offset}"
+        entry = index.payloads.get(key) if index is not None else None
+        if entry:
+            m_size, ms_size = entry["m_size"], entry["ms_size"]
+            manifest = Manifest.from_dict(entry["manifest"])
+        else:
+            header = await self.client.fetch_range(offset, offset + 30)
+            m_size = struct.unpack(">Q", header[12:20])[0]
+            ms_size = struct.unpack(">I", header[20:24])[0]
+            
+            m_data = await self.client.fetch_range(offset+24, offset+24+m_size)
+            loop = asyncio.get_running_loop()
+            manifest = await loop.run_in_executor(self.executor, Manifest.parse, m_data)
+            if index is not None:
+                index.payloads[key] = {"m_size": m_size, "ms_size": ms_size, "manifest": manifest.to_dict()}
+                index.dirty = True
+
+        self._manifest = (manifest, offset + 24 + m_size + ms_size)
+        return self._manifest
+
+    async def extract(self, partition, output):
+        await self.extract_many({partition: output})
+
+    def _plan(self, parts, skip=None):
+        # Operations of every requested partition are planned together, so
+        # neighbouring data from different partitions shares one fetch.
+        skip = skip or [()] * len(parts)
+        spans = [
+            (part.offsets[i], part.offsets[i] + part.lengths[i], (ti, i))
+            for ti, part in enumerate(parts)
+            for i in range(len(part)) if part.lengths[i] and i not in skip[ti]
+        ]
+        planner = self.planner or BatchPlanner.for_client(self.client)
+        return planner, planner.plan(spans), sum(e - s for s, e, _ in spans)
+
+    def _partitions(self, manifest, names):
+        parts = []
+        for partition in names:
+            part = manifest.partitions.get(partition)
+            if not part or not len(part): raise Exception(f"Partition {partition} not found")
+            parts.append(part)
+        return parts
+
+    async def plan(self, partitions):
+        manifest, _ = await self.load_manifest()
+        planner, groups, useful = self._plan(self._partitions(manifest, partitions))
+        return planner.describe(groups, useful)
+
+    async def _open_sources(self, parts, sinks, sources, images):
+        # Incremental partitions are rebuilt from the image they were diffed
+        # against; a wrong base is caught here, before anything is fetched.
+        loop = asyncio.get_running_loop()
+        for part, sink in zip(parts, sinks):
+            bad = unsupported_ops(part)
+            if bad: raise Exception(f"Partition {part.name} uses unsupported operations: {', '.join(bad)}")
+            if not needs_source(part): continue
+            if part.name not in sources:
+                raise Exception(f"Partition {part.name} is an incremental update and needs its source image")
+            path = os.path.abspath(sources[part.name])
+            if getattr(sink, "path", None) and os.path.abspath(sink.path) == path:
+                raise Exception(f"Output for {part.name} would overwrite its source image")
+            src = images[part.name] = SourceImage(path)
+            if part.old_hash:
+                if src.size < part.old_size or await loop.run_in_executor(
+                    self.executor, src.sha256, part.old_size
+                ) != part.old_hash:
+                    raise Exception(f"Source image for {part.name} is not the one this update was built from")
+                src.verified = True
+
+    async def extract_many(self, jobs, sources=None):
+        manifest, base_off = await self.load_manifest()
+        parts = self._partitions(manifest, jobs)
+        sinks = [as_sink(t) for t in jobs.values()]
+        images = {}
+        try:
+            await self._open_sources(parts, sinks, sources or {}, images)
+            jobs = [(p, s, images.get(p.name)) for p, s in zip(parts, sinks)]
+            mapped = [job for job in jobs if job[1].random_access]
+            streamed = [job for job in jobs if not job[1].random_access]
+            await gather_or_cancel(
+                *([self._extract_mapped(mapped, manifest.block_size, base_off)] if mapped else []),
+                *(self._extract_streamed(*job, manifest.block_size, base_off) for job in streamed)
+            )
+        finally:
+            for src in images.values(): src.close()
+
+    async def _extract_mapped(self, jobs, bs, base_off):
+        parts = [part for part, _, _ in jobs]
         
-        for op in ops:
-            if not op['len']: continue
-            s, e = op['off'], op['off'] + op['len']
-            if not c_batch:
-                c_batch, b_start, b_end = [op], s, e
-            elif (s - b_end <= 1048576) and ((e - b_start) <= 33554432):
-                c_batch.append(op)
-                b_end = e
-            else:
-                batches.append((c_batch, b_start, b_end))
-                c_batch, b_start, b_end = [op], s, e
-        if c_batch: batches.append((c_batch, b_start, b_end))
+        targets = []
+        journals = []
+        with ExitStack() as stack:
+            for part, sink, src in jobs:
+                stack.enter_context(closing_sink(sink))
+                size = part.output_blocks() * bs
+                target = f"{base_off}/{part.name}" + (f"@{src.key}" if src else "")
+                journal = open_journal(self.client, sink, target, size)
+                journals.append(journal)
+                targets.append((part, sink.map(size, keep=bool(journal and journal.done)), src))
+            skip = [j.done if j else () for j in journals]
+            _, groups, _ = self._plan(parts, skip)
+            try:
+                await gather_or_cancel(
+                    self._run_groups(targets, groups, bs, base_off, journals),
+                    self._run_local(targets, bs, journals, skip)
+                )
+            finally:
+                for journal in journals:
+                    if journal: journal.flush()
+            for journal in journals:
+                if journal: journal.finish()
 
+    async def _run_local(self, targets, bs, journals, skip):
+        # Source copies carry no payload data and are applied straight from
+        # the source image, alongside the fetches.
+        sem = asyncio.Semaphore(self.workers)
+        loop = asyncio.get_running_loop()
+
+        async def apply(ti, i):
+            part, mm, src = targets[ti]
+            async with sem:
+                await loop.run_in_executor(self.executor, self._apply_op, b"", part, i, mm, bs, src)
+            if journals[ti]: journals[ti].mark(i)
+
+        await gather_or_cancel(*(
+            apply(ti, i)
+            for ti, (part, _, src) in enumerate(targets) if src
+            for i in range(len(part))
+            if not part.lengths[i] and part.types[i] in SOURCE_OPS and i not in skip[ti]
+        ))
+
+    async def _run_groups(self, targets, groups, bs, base_off, journals=None):
         sem = asyncio.Semaphore(self.client.concurrency)
+        loop = asyncio.get_running_loop()
         
-        async def worker(batch):
-            ops_in, start, end = batch
+        async def apply(op_sem, comp, ti, i):
+            part, mm, src = targets[ti]
+            async with op_sem:
+                comp = await self._verified(part, i, comp, base_off)
+                await loop.run_in_executor(self.executor, self._apply_op, comp, part, i, mm, bs, src)
+            if journals and journals[ti]: journals[ti].mark(i)
+
+        async def worker(group):
+            # The fetched buffers and the output pieces of the ops that may
+            # run in parallel are reserved together, before the fetch, so a
+            # full budget holds back new fetches rather than stalling ops.
+            n_ops = sum(len(ops_in) for ops_in, _, _ in group)
+            parallel = min(n_ops, self.workers)
+            cost = sum(end - start for _, start, end in group) + parallel * OP_OUTPUT_COST
+            async with self.budget.reserve(cost):
+                async with sem:
+                    raws = await self.client.fetch_ranges(
+                        [(base_off + start, base_off + end) for _, start, end in group]
+                    )
+                op_sem = asyncio.Semaphore(parallel)
+                tasks = []
+                for (ops_in, start, end), raw in zip(group, raws):
+                    mv = memoryview(raw)
+                    for ti, i in ops_in:
+                        r_start = targets[ti][0].offsets[i] - start
+                        comp = mv[r_start : r_start + targets[ti][0].lengths[i]]
+                        tasks.append(apply(op_sem, comp, ti, i))
+                await asyncio.gather(*tasks)
+
+        await gather_or_cancel(*(worker(g) for g in groups))
+
+    @staticmethod
+    def _stream_order(part):
+        # Ops sorted by output position, or None when their outputs overlap
+        # or their data is not laid out in that same order.
+        order = sorted(
+            (i for i in range(len(part)) if part.ext_index[i + 1] > part.ext_index[i]),
+            key=lambda i: part.ext_start[part.ext_index[i]]
+        )
+        block = data_end = 0
+        for i in order:
+            for sb, nb in part.extents(i):
+                if sb < block: return None
+                block = sb + nb
+            if part.lengths[i]:
+                if part.offsets[i] < data_end: return None
+                data_end = part.offsets[i] + part.lengths[i]
+        return order
+
+    def _stream_op(self, data, part, i, sink, bs, pos, src=None):
+        pieces = iter(self._op_pieces(data, part, i, bs, src))
+        mv = memoryview(b"")
+        for sb, nb in part.extents(i):
+            write_zeros(sink, sb * bs - pos)
+            pos, left = sb * bs, nb * bs
+            while left:
+                if not len(mv):
+                    piece = next(pieces, None)
+                    if piece is None: break
+                    mv = memoryview(piece)
+                    continue
+                n = min(left, len(mv))
+                sink.write(mv[:n])
+                mv, left, pos = mv[n:], left - n, pos + n
+            # Data short of its extents leaves zeros, as in a mapped output.
+            write_zeros(sink, left)
+            pos += left
+        return pos
+
+    async def _extract_streamed(self, part, sink, src, bs, base_off):
+        size = part.output_blocks() * bs
+        order = self._stream_order(part)
+        if order is None:
+            # Not streamable: build the image in a temporary file, so its
+            # size is bounded by the disk rather than memory, then copy.
+            with tempfile.TemporaryFile(dir=self.temp_dir) as f:
+                f.truncate(max(size, 1))
+                buffer = mmap.mmap(f.fileno(), max(size, 1))
+                try:
+                    await self._extract_mapped([(part, MmapSink(buffer), src)], bs, base_off)
+                    with closing_sink(sink):
+                        sink.open(size)
+                        loop = asyncio.get_running_loop()
+                        for off in range(0, size, OUTPUT_PIECE):
+                            await loop.run_in_executor(self.executor, sink.write, buffer[off : off + OUTPUT_PIECE])
+                finally:
+                    buffer.close()
+            return
+
+        _, groups, _ = self._plan([part])
+        sem = asyncio.Semaphore(self.client.concurrency)
+        loop = asyncio.get_running_loop()
+        pending = groups[::-1]
+        window = deque()
+
+        async def fetch(group):
             async with sem:
-                raw = await self.client.fetch_range(base_off + start, base_off + end)
+                raws = await self.client.fetch_ranges(
+                    [(base_off + start, base_off + end) for _, start, end in group]
+                )
+            ops = {}
+            for (ops_in, start, _), raw in zip(group, raws):
                 mv = memoryview(raw)
-                loop = asyncio.get_running_loop()
-                for op in ops_in:
-                    r_start = op['off'] - start
-                    comp = mv[r_start : r_start + op['len']]
-                    dec = await loop.run_in_executor(self.executor, self._decompress, comp, op['t'])
-                    ptr = 0
-                    for sb, nb in op['dst']:
-                        sz = nb * 4096
-                        mm[sb*4096 : sb*4096+sz] = dec[ptr:ptr+sz]
-                        ptr += sz
-
-        await asyncio.gather(*(worker(b) for b in batches))
-        mm.close()
-        os.close(fd)
-        self.executor.shutdown()
+                for _, i in ops_in:
+                    r_start = part.offsets[i] - start
+                    ops[i] = mv[r_start : r_start + part.lengths[i]]
+            return ops
+
+        async def refill():
+            # Fetches are started in output order and only while the budget
+            # has room, so the group the writer needs next is never starved
+            # by ones queued behind it.
+            while pending and len(window) < self.client.concurrency:
+                cost = sum(end - start for _, start, end in pending[-1]) + OP_OUTPUT_COST
+                if not window: await self.budget.acquire(cost)
+                elif not self.budget.try_acquire(cost): break
+                window.append((cost, asyncio.ensure_future(fetch(pending.pop()))))
+
+        with closing_sink(sink):
+            sink.open(size)
+            # Output is produced in order here, so the partition hash comes
+            # for free on top of the per-op checks.
+            out = HashingSink(sink, part.size)
+            data, held, pos = {}, 0, 0
+            try:
+                for i in order:
+                    if part.lengths[i] and i not in data:
+                        if held: await self.budget.release(held)
+                        held = 0
+                        await refill()
+                        held, task = window.popleft()
+                        data = await task
+                        await refill()
+                    comp = await self._verified(part, i, data.pop(i, b""), base_off)
+                    pos = await loop.run_in_executor(
+                        self.executor, self._stream_op, comp, part, i, out, bs, pos, src
+                    )
+                await loop.run_in_executor(self.executor, write_zeros, out, size - pos)
+                if part.hash and out.digest() != part.hash:
+                    raise Exception(f"Partition {part.name} does not match its manifest hash")
+            finally:
+                for cost, task in window:
+                    task.cancel()
+                    held += cost
+                await asyncio.gather(*(t for _, t in window), return_exceptions=True)
+                if held: await self.budget.release(held)
@@ -0,0 +1,90 @@
+from .network import MAX_RANGES_PER_REQUEST
+
+DEFAULT_RTT = 0.1
+DEFAULT_BANDWIDTH = 4 * 1024 * 1024
+MIN_GROUP_BYTES = 1024 * 1024
+MAX_GROUP_BYTES = 32 * 1024 * 1024
+GROUP_RTTS = 8
+MIN_GAP_BYTES = 256 * 1024
+
+class BatchPlanner:
+    def __init__(self, rtt=None, bandwidth=None, concurrency=1, multi_range=True, max_group=MAX_GROUP_BYTES):
+        self.measured = rtt is not None and bandwidth is not None
+        self.rtt = rtt or DEFAULT_RTT
+        self.bandwidth = bandwidth or DEFAULT_BANDWIDTH
+        self.concurrency = max(1, concurrency)
+        self.ranges_per_request = MAX_RANGES_PER_REQUEST if multi_range else 1
+        self.max_group = max_group
+
+    @classmethod
+    def for_client(cls, client):
+        link = client.link()
+        return cls(link["rtt"], link["bandwidth"], link["concurrency"], link["multi_range"])
+
+    @property
+    def max_gap(self):
+        # Reading a gap costs gap / bandwidth; splitting there costs one more
+        # range, i.e. a share of a round trip once ranges are packed into
+        # multi-range requests. Each gap is independent, so merging exactly
+        # those below the break-even point minimises the modelled time. The
+        # model ignores per-range server and parsing overhead, which small
+        # gaps would multiply on fast links, so they are always merged.
+        return int(max(self.rtt * self.bandwidth / self.ranges_per_request, MIN_GAP_BYTES))
+
+    def group_bytes(self, total):
+        # Big enough that the round trip is a small part of each request,
+        # small enough that every connection still gets work.
+        size = min(GROUP_RTTS * self.rtt * self.bandwidth, total / self.concurrency)
+        return int(max(MIN_GROUP_BYTES, min(size, self.max_group)))
+
+    def plan(self, spans):
+        spans = sorted(spans, key=lambda s: s[0])
+        limit = self.group_bytes(sum(e - s for s, e, _ in spans))
+        max_gap = self.max_gap
+
+        batches = []
+        c_batch, b_start, b_end = [], -1, -1
+        for s, e, item in spans:
+            if not c_batch:
+                c_batch, b_start, b_end = [item], s, e
+            elif s - b_end <= max_gap and e - b_start <= limit:
+                c_batch.append(item)
+                b_end = max(b_end, e)
+            else:
+                batches.append((c_batch, b_start, b_end))
+                c_batch, b_start, b_end = [item], s, e
+        if c_batch: batches.append((c_batch, b_start, b_end))
+
+        groups = []
+        c_group, g_bytes = [], 0
+        for batch in batches:
+            size = batch[2] - batch[1]
+            if c_group and (g_bytes + size > limit or len(c_group) >= self.ranges_per_request):
+                groups.append(c_group)
+                c_group, g_bytes = [], 0
+            c_group.append(batch)
+            g_bytes += size
+        if c_group: groups.append(c_group)
+        return groups
+
+    def estimate(self, groups):
+        fetched = sum(end - start for group in groups for _, start, end in group)
+        lanes = max(1, min(self.concurrency, len(groups)))
+        return (len(groups) * self.rtt + fetched / self.bandwidth) / lanes
+
+    def describe(self, groups, useful):
+        fetched = sum(end - start for group in groups for _, start, end in group)
+        return {
+            "rtt": self.rtt,
+            "bandwidth": self.bandwidth,
+            "measured": self.measured,
+            "concurrency": self.concurrency,
+            "max_gap": self.max_gap,
+            "group_bytes": self.group_bytes(useful),
+            "requests": len(groups),
+            "ranges": sum(len(g) for g in groups),
+            "useful_bytes": useful,
+            "fetched_bytes": fetched,
+            "estimated_seconds": round(self.estimate(groups), 3),
+            "groups": [[[start, end, len(items)] for items, start, end in g] for g in groups],
+        }
@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import mmap
+import os
+from contextlib import contextmanager
+
+ZEROS = bytes(1024 * 1024)
+_END = object()
+
+class FileSink:
+    random_access = True
+
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.resume = resume
+        self._f = None
+        self._fd = None
+        self._mm = None
+
+    def map(self, size, keep=False):
+        # keep: reuse what an interrupted run already wrote.
+        with open(self.path, "r+b" if keep else "wb") as f: f.truncate(size)
+        if not size: return None
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            self._mm = mmap.mmap(fd, size)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return self._mm
+
+    def open(self, size):
+        if self._f is not None: self._f.close()
+        self._f = open(self.path, "wb")
+
+    def write(self, data):
+        self._f.write(data)
+
+    def close(self, error=None):
+        if self._mm is not None: self._mm.close()
+        if self._fd is not None: os.close(self._fd)
+        if self._f is not None: self._f.close()
+        self._f = self._fd = self._mm = None
+
+
+class MmapSink:
+    random_access = True
+
+    def __init__(self, buffer=None):
+        self.buffer = buffer
+        self._pos = 0
+
+    def map(self, size, keep=False):
+        if self.buffer is None: self.buffer = mmap.mmap(-1, max(size, 1))
+        elif len(self.buffer) < size: raise Exception("Output buffer is too small")
+        return self.buffer
+
+    def open(self, size):
+        self.map(size)
+        self._pos = 0
+
+    def write(self, data):
+        self.buffer[self._pos : self._pos + len(data)] = data
+        self._pos += len(data)
+
+    def close(self, error=None):
+        pass
+
+
+class StreamSink:
+    random_access = False
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def open(self, size):
+        pass
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def close(self, error=None):
+        self.stream.flush()
+
+
+class AsyncIterSink:
+    # write() runs on executor threads and blocks while the queue is full,
+    # so a slow reader throttles extraction instead of buffering the image.
+    random_access = False
+
+    def __init__(self, maxsize=8):
+        self.size = None
+        self._queue = asyncio.Queue(maxsize)
+        self._loop = None
+        self._error = None
+        self._cancelled = False
+        self._opened = asyncio.Event()
+
+    def open(self, size):
+        self.size = size
+        self._loop = asyncio.get_running_loop()
+        self._opened.set()
+
+    def write(self, data):
+        if self._cancelled: raise Exception("Output stream closed by the reader")
+        asyncio.run_coroutine_threadsafe(self._queue.put(bytes(data)), self._loop).result()
+
+    def close(self, error=None):
+        self._error = error
+        self._opened.set()
+        asyncio.ensure_future(self._queue.put(_END))
+
+    async def opened(self):
+        await self._opened.wait()
+        if self._error is not None: raise self._error
+        return self.size
+
+    def cancel(self):
+        self._cancelled = True
+        while not self._queue.empty(): self._queue.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is _END:
+            self._queue.put_nowait(_END)
+            if self._error is not None: raise self._error
+            raise StopAsyncIteration
+        return item
+
+
+class HashingSink:
+    def __init__(self, sink, limit):
+        self.sink = sink
+        self.left = limit
+        self._hash = hashlib.sha256()
+
+    def write(self, data):
+        if self.left > 0:
+            n = min(self.left, len(data))
+            self._hash.update(data[:n])
+            self.left -= n
+        self.sink.write(data)
+
+    def digest(self):
+        return self._hash.digest()
+
+
+def as_sink(target):
+    if isinstance(target, (str, os.PathLike)): return FileSink(target)
+    return target
+
+@contextmanager
+def closing_sink(sink):
+    try:
+        yield sink
+    except BaseException as e:
+        sink.close(e)
+        raise
+    else:
+        sink.close()
+
+def write_zeros(sink, n):
+    while n > 0:
+        k = min(n, len(ZEROS))
+        sink.write(memoryview(ZEROS)[:k])
+        n -= k
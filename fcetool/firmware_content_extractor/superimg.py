@@ -0,0 +1,220 @@
+import hashlib
+import struct
+from bisect import bisect_right
+from .concurrency import run_pieces, write_ordered
+from .journal import open_journal
+from .network import SubFileClient
+from .sinks import as_sink, closing_sink
+
+SPARSE_MAGIC = 0xED26FF3A
+CHUNK_RAW, CHUNK_FILL, CHUNK_DONT_CARE, CHUNK_CRC32 = 0xCAC1, 0xCAC2, 0xCAC3, 0xCAC4
+SPARSE_READAHEAD = 64 * 1024
+
+LP_RESERVED_BYTES = 4096
+LP_GEOMETRY_SIZE = 4096
+LP_GEOMETRY_MAGIC = 0x616C4467
+LP_HEADER_MAGIC = 0x414C5030
+LP_SECTOR_SIZE = 512
+LP_TARGET_LINEAR, LP_TARGET_ZERO = 0, 1
+
+PIECE_SIZE = 4 * 1024 * 1024
+STREAM_WINDOW = 8
+
+async def read_sparse_chunks(client, size):
+    # Chunk table of an Android sparse image as [raw_offset, length, kind,
+    # value] rows: value is the file offset of raw data or the fill word.
+    # Headers can only be found by walking them, so this costs a request
+    # per raw chunk; the result is kept in the archive index.
+    head = bytes(await client.fetch_range(0, 28))
+    if len(head) < 28 or struct.unpack_from("<I", head)[0] != SPARSE_MAGIC: return None
+    _, major, _, file_hdr, chunk_hdr, blk_sz, total_blks, total_chunks, _ = struct.unpack("<IHHHHIIII", head)
+    if major != 1: raise Exception(f"Unsupported sparse image version {major}")
+
+    chunks = []
+    pos, raw = file_hdr, 0
+    buf, buf_start = b"", 0
+    for _ in range(total_chunks):
+        if not buf_start <= pos or pos + chunk_hdr + 4 > buf_start + len(buf):
+            buf_start = pos
+            buf = bytes(await client.fetch_range(pos, min(pos + SPARSE_READAHEAD, size)))
+        kind, _, n_blocks, total = struct.unpack_from("<HHII", buf, pos - buf_start)
+        length = n_blocks * blk_sz
+        if kind == CHUNK_RAW: chunks.append([raw, length, kind, pos + chunk_hdr])
+        elif kind == CHUNK_FILL: chunks.append([raw, length, kind, struct.unpack_from("<I", buf, pos - buf_start + chunk_hdr)[0]])
+        elif kind == CHUNK_DONT_CARE: chunks.append([raw, length, kind, 0])
+        elif kind != CHUNK_CRC32: raise Exception(f"Unknown sparse chunk type {kind:#x}")
+        raw += length
+        pos += total
+    if raw != total_blks * blk_sz: raise Exception("Sparse image chunks do not add up")
+    return chunks
+
+
+class SparseView:
+    # Reads of the unsparsed image, served from the raw chunks of the file
+    # underneath; a plain image is a single raw chunk.
+    def __init__(self, parent, chunks):
+        self.parent = parent
+        self.chunks = chunks
+        self._starts = [c[0] for c in chunks]
+        self.size = chunks[-1][0] + chunks[-1][1] if chunks else 0
+
+    def _segments(self, start, end):
+        k = max(bisect_right(self._starts, start) - 1, 0)
+        while start < end and k < len(self.chunks):
+            c_start, c_len, kind, value = self.chunks[k]
+            n = min(end, c_start + c_len) - start
+            if n > 0:
+                yield kind, start - c_start, n, value
+                start += n
+            k += 1
+        if start < end: raise Exception("Read past the end of the sparse image")
+
+    async def fetch_ranges(self, ranges):
+        # Raw pieces of every range go out in one fetch_ranges call, so the
+        # client can merge them into multi-range requests.
+        plans, raws = [], []
+        for start, end in ranges:
+            plan = list(self._segments(start, end))
+            raws += [(value + off, value + off + n) for kind, off, n, value in plan if kind == CHUNK_RAW]
+            plans.append(plan)
+        fetched = iter(await self.parent.fetch_ranges(raws)) if raws else iter(())
+
+        out = []
+        for plan in plans:
+            parts = []
+            for kind, off, n, value in plan:
+                if kind == CHUNK_RAW: parts.append(next(fetched))
+                elif kind == CHUNK_FILL:
+                    word = struct.pack("<I", value)
+                    parts.append((word * (n // 4 + 2))[off % 4 : off % 4 + n])
+                else: parts.append(bytes(n))
+            out.append(parts[0] if len(parts) == 1 else b"".join(parts))
+        return out
+
+    async def fetch_range(self, start, end):
+        return (await self.fetch_ranges([(start, end)]))[0]
+
+
+def _parse_geometry(data):
+    magic, struct_size, checksum, max_size, slots, block_size = struct.unpack_from("<II32sIII", data)
+    if magic != LP_GEOMETRY_MAGIC or struct_size > len(data): return None
+    body = bytearray(data[:struct_size])
+    body[8:40] = bytes(32)
+    if hashlib.sha256(body).digest() != checksum: return None
+    return max_size
+
+def _table(tables, desc, fmt):
+    offset, count, size = desc
+    return [struct.unpack_from(fmt, tables, offset + k * size) for k in range(count)]
+
+async def read_lp_metadata(view):
+    # Logical partitions of slot 0 as {name: [[raw_offset, length, linear]]}.
+    # Extents on other block devices (retrofit supers) are not supported.
+    head = bytes(await view.fetch_range(LP_RESERVED_BYTES, LP_RESERVED_BYTES + 2 * LP_GEOMETRY_SIZE))
+    max_size = _parse_geometry(head[:LP_GEOMETRY_SIZE]) or _parse_geometry(head[LP_GEOMETRY_SIZE:])
+    if max_size is None: raise Exception("No valid LP metadata geometry in super image")
+
+    base = LP_RESERVED_BYTES + 2 * LP_GEOMETRY_SIZE
+    meta = bytes(await view.fetch_range(base, base + max_size))
+    magic, major, _, header_size, header_sum, tables_size, tables_sum = struct.unpack_from("<IHHI32sI32s", meta)
+    if magic != LP_HEADER_MAGIC or major != 10: raise Exception("Unsupported LP metadata header")
+    header = bytearray(meta[:header_size])
+    header[12:44] = bytes(32)
+    tables = meta[header_size : header_size + tables_size]
+    if hashlib.sha256(header).digest() != header_sum or hashlib.sha256(tables).digest() != tables_sum:
+        raise Exception("LP metadata checksum mismatch")
+
+    descs = [struct.unpack_from("<III", meta, 80 + 12 * k) for k in range(4)]
+    extents = _table(tables, descs[1], "<QIQI")
+    partitions = {}
+    for name, _, first, count, _ in _table(tables, descs[0], "<36sIIII"):
+        spans = []
+        for sectors, target, data, source in extents[first : first + count]:
+            if target == LP_TARGET_LINEAR and source != 0:
+                raise Exception("Logical partition spans another block device")
+            spans.append([data * LP_SECTOR_SIZE, sectors * LP_SECTOR_SIZE, target == LP_TARGET_LINEAR])
+        partitions[name.rstrip(b"\0").decode()] = spans
+    return partitions
+
+
+class SuperExtractor:
+    def __init__(self, client, view, partitions):
+        self.client = client
+        self.view = view
+        self.partitions = partitions
+
+    @classmethod
+    async def open(cls, client, offset, size):
+        sub = SubFileClient(client, offset, size)
+        index = client.get_index()
+        key = f"{client.origin}/{offset}"
+        entry = index.supers.get(key) if index is not None else None
+        if entry is None:
+            chunks = await read_sparse_chunks(sub, size) or [[0, size, CHUNK_RAW, 0]]
+            entry = {"chunks": chunks, "partitions": await read_lp_metadata(SparseView(sub, chunks))}
+            if index is not None:
+                index.supers[key] = entry
+                index.dirty = True
+        return cls(sub, SparseView(sub, entry["chunks"]), entry["partitions"])
+
+    def names(self):
+        # Slot suffixes are dropped for lookups when the other slot is empty,
+        # as in the supers shipped with fastboot ROMs.
+        out = {}
+        for name, spans in self.partitions.items():
+            if not spans: continue
+            out[name] = name
+            base, sep, slot = name.rpartition("_")
+            if sep and slot in ("a", "b") and not self.partitions.get(f"{base}_{'b' if slot == 'a' else 'a'}"):
+                out.setdefault(base, name)
+        return out
+
+    def _pieces(self, name):
+        # Output split into PIECE_SIZE pieces, each a list of (raw_offset or
+        # None for zeros, length) spans.
+        pieces, cur, room = [], [], PIECE_SIZE
+        for raw, length, linear in self.partitions[name]:
+            while length:
+                n = min(length, room)
+                cur.append((raw if linear else None, n))
+                raw, length, room = raw + n, length - n, room - n
+                if not room:
+                    pieces.append(cur)
+                    cur, room = [], PIECE_SIZE
+        if cur: pieces.append(cur)
+        return pieces
+
+    def plan(self, name):
+        spans = self.partitions[name]
+        return {
+            "size": sum(n for _, n, _ in spans),
+            "extents": len(spans),
+            "mapped_bytes": sum(n for _, n, linear in spans if linear),
+        }
+
+    async def _fetch_piece(self, piece):
+        raws = [(raw, raw + n) for raw, n in piece if raw is not None]
+        data = iter(await self.view.fetch_ranges(raws)) if raws else iter(())
+        parts = [next(data) if raw is not None else bytes(n) for raw, n in piece]
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    async def extract(self, name, output):
+        pieces = self._pieces(name)
+        size = sum(n for piece in pieces for _, n in piece)
+        with closing_sink(as_sink(output)) as sink:
+            if not sink.random_access:
+                sink.open(size)
+                await write_ordered(self.client, sink.write, (self._fetch_piece(p) for p in pieces), STREAM_WINDOW)
+                return
+
+            journal = open_journal(self.client, sink, f"super/{name}/{PIECE_SIZE}", size)
+            mm = sink.map(size, keep=bool(journal and journal.done))
+            if not size: return
+
+            async def work(k):
+                data = await self._fetch_piece(pieces[k])
+                mm[k * PIECE_SIZE : k * PIECE_SIZE + len(data)] = data
+                return True
+
+            await run_pieces(self.client, len(pieces), work, journal)
+            if journal: journal.finish()
@@ -0,0 +1,315 @@
+import asyncio
+import bisect
+import ctypes
+import ctypes.util
+import zlib
+from base64 import b64decode, b64encode
+
+WINDOW_SIZE = 32768
+MIN_SPAN = 4 * 1024 * 1024
+MAX_POINTS = 64
+
+Z_OK, Z_STREAM_END, Z_BUF_ERROR, Z_BLOCK = 0, 1, -5, 5
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ("next_in", ctypes.c_void_p),
+        ("avail_in", ctypes.c_uint),
+        ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p),
+        ("avail_out", ctypes.c_uint),
+        ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p),
+        ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p),
+        ("zfree", ctypes.c_void_p),
+        ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int),
+        ("adler", ctypes.c_ulong),
+        ("reserved", ctypes.c_ulong),
+    ]
+
+def _load_libz():
+    # The zlib module exposes neither Z_BLOCK (to find deflate block
+    # boundaries) nor inflatePrime (to resume mid-byte), so random access
+    # into deflate streams talks to libz directly.
+    for name in (ctypes.util.find_library("z"), "libz.so.1", "libz.dylib", "zlib1.dll"):
+        if not name: continue
+        try: lib = ctypes.CDLL(name)
+        except OSError: continue
+        lib.zlibVersion.restype = ctypes.c_char_p
+        lib.inflateInit2_.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        lib.inflate.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int]
+        lib.inflateEnd.argtypes = [ctypes.POINTER(_ZStream)]
+        lib.inflatePrime.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_int, ctypes.c_int]
+        lib.inflateSetDictionary.argtypes = [ctypes.POINTER(_ZStream), ctypes.c_char_p, ctypes.c_uint]
+        return lib
+    return None
+
+_libz = _load_libz()
+ZRAN_AVAILABLE = _libz is not None
+
+
+class _RawInflate:
+    # on_output(chunk) sees each piece of output and on_block(strm) each
+    # stop at a deflate block boundary (with flush=Z_BLOCK).
+    def __init__(self, out_chunk=256 * 1024, on_output=None, on_block=None):
+        self._open = False
+        self._on_output = on_output
+        self._on_block = on_block
+        self.unconsumed_tail = b""
+        self._out = ctypes.create_string_buffer(out_chunk)
+        self._done = False
+        self._strm = _ZStream()
+        ret = _libz.inflateInit2_(ctypes.byref(self._strm), -zlib.MAX_WBITS, _libz.zlibVersion(), ctypes.sizeof(_ZStream))
+        if ret != Z_OK: raise Exception(f"inflateInit2 failed ({ret})")
+        self._open = True
+
+    def prime(self, bits, value):
+        if _libz.inflatePrime(ctypes.byref(self._strm), bits, value) != Z_OK:
+            raise Exception("inflatePrime failed")
+
+    def set_dictionary(self, window):
+        if _libz.inflateSetDictionary(ctypes.byref(self._strm), window, len(window)) != Z_OK:
+            raise Exception("inflateSetDictionary failed")
+
+    def decompress(self, data, max_length=0, flush=0):
+        data = bytes(data)
+        src = ctypes.c_char_p(data)
+        strm = self._strm
+        strm.next_in = ctypes.cast(src, ctypes.c_void_p).value
+        strm.avail_in = len(data)
+        out, produced = [], 0
+
+        while not self._done:
+            room = len(self._out)
+            if max_length: room = min(room, max_length - produced)
+            strm.next_out = ctypes.addressof(self._out)
+            strm.avail_out = room
+            ret = _libz.inflate(ctypes.byref(strm), flush)
+            if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+                raise zlib.error(f"inflate failed ({ret})")
+
+            n = room - strm.avail_out
+            if n:
+                out.append(ctypes.string_at(self._out, n))
+                produced += n
+                if self._on_output: self._on_output(out[-1])
+            if ret == Z_STREAM_END:
+                self._done = True
+                break
+            if flush == Z_BLOCK and self._on_block: self._on_block(strm)
+
+            if max_length and produced >= max_length: break
+            if strm.avail_in == 0 and strm.avail_out: break
+            if ret == Z_BUF_ERROR and not n: break
+
+        self.unconsumed_tail = data[len(data) - strm.avail_in:] if strm.avail_in else b""
+        return b"".join(out)
+
+    def flush(self):
+        out = self.decompress(b"")
+        self.close()
+        return out
+
+    def close(self):
+        if self._open:
+            _libz.inflateEnd(ctypes.byref(self._strm))
+            self._open = False
+
+    def __del__(self):
+        self.close()
+
+
+class IndexBuilder(_RawInflate):
+    def __init__(self, span):
+        super().__init__(on_output=self._keep_window, on_block=self._checkpoint)
+        self.span = span
+        self.points = [(0, 0, 0, b"")]
+        self._window = b""
+
+    def decompress(self, data, max_length=0):
+        return super().decompress(data, max_length, Z_BLOCK)
+
+    def _keep_window(self, chunk):
+        self._window = (self._window + chunk)[-WINDOW_SIZE:]
+
+    def _checkpoint(self, strm):
+        # Bit 128: stopped right after an end-of-block code; bit 64: the
+        # last block has started, so no restart point is useful there.
+        dt = strm.data_type
+        if dt & 128 and not dt & 64 and strm.total_out - self.points[-1][2] > self.span:
+            self.points.append((strm.total_in, dt & 7, strm.total_out, self._window))
+
+
+def inflate_segment(data, point, out_len):
+    _, bits, _, window = point
+    inflater = _RawInflate()
+    try:
+        if bits:
+            # The block starts inside the first byte; hand its remaining
+            # high bits to zlib before the byte-aligned rest of the input.
+            inflater.prime(bits, data[0] >> (8 - bits))
+            data = data[1:]
+        if window: inflater.set_dictionary(window)
+        out = inflater.decompress(data, out_len)
+    finally:
+        inflater.close()
+    if len(out) != out_len: raise Exception("Deflate checkpoint does not match stream")
+    return out
+
+
+class DeflateIndex:
+    def __init__(self, points, comp_size, size):
+        self.points = points
+        self.comp_size = comp_size
+        self.size = size
+        self._outs = [p[2] for p in points]
+
+    def locate(self, offset):
+        return bisect.bisect_right(self._outs, offset) - 1
+
+    def segment(self, k):
+        in_off, bits, out_off, _ = self.points[k]
+        c_start = in_off - 1 if bits else in_off
+        if k + 1 < len(self.points):
+            nxt = self.points[k + 1]
+            return c_start, min(nxt[0] + 1, self.comp_size), out_off, nxt[2] - out_off
+        return c_start, self.comp_size, out_off, self.size - out_off
+
+    def to_dict(self):
+        return {
+            "comp_size": self.comp_size,
+            "size": self.size,
+            "points": [[i, b, o, b64encode(zlib.compress(w)).decode()] for i, b, o, w in self.points],
+        }
+
+    @classmethod
+    def from_dict(cls, doc):
+        points = [(i, b, o, zlib.decompress(b64decode(w))) for i, b, o, w in doc["points"]]
+        return cls(points, doc["comp_size"], doc["size"])
+
+
+def load_deflate_index(client, key):
+    if not ZRAN_AVAILABLE: return None
+    index = client.get_index()
+    doc = index.deflate.get(key) if index is not None else None
+    return DeflateIndex.from_dict(doc) if doc else None
+
+def store_deflate_index(client, key, dindex):
+    index = client.get_index()
+    if index is not None:
+        index.deflate[key] = dindex.to_dict()
+        index.dirty = True
+
+
+async def stream_inflate(client, start_pos, comp_size, decompressor, sink=None, prefetch=4):
+    end_pos = start_pos + comp_size
+    chunk_size = 4 * 1024 * 1024
+    loop = asyncio.get_running_loop()
+    fetched = asyncio.Queue(maxsize=prefetch)
+    inflated = asyncio.Queue(maxsize=prefetch)
+
+    # fetch -> inflate -> write run as separate stages so the link keeps
+    # streaming while zlib and the disk work off the event loop thread.
+    async def fetcher():
+        for cur in range(start_pos, end_pos, chunk_size):
+            task = asyncio.ensure_future(client.fetch_range(cur, min(cur + chunk_size, end_pos)))
+            await fetched.put(task)
+        await fetched.put(None)
+
+    async def inflater():
+        while True:
+            task = await fetched.get()
+            if task is None: break
+            buf = await task
+            while buf:
+                out = await loop.run_in_executor(None, decompressor.decompress, buf, 4 * chunk_size)
+                await inflated.put(out)
+                buf = decompressor.unconsumed_tail
+        await inflated.put(await loop.run_in_executor(None, decompressor.flush))
+        await inflated.put(None)
+
+    async def writer():
+        while True:
+            out = await inflated.get()
+            if out is None: break
+            if sink is not None:
+                await loop.run_in_executor(None, sink, out)
+
+    stages = [asyncio.ensure_future(c) for c in (fetcher(), inflater(), writer())]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        for t in stages: t.cancel()
+        while not fetched.empty():
+            task = fetched.get_nowait()
+            if task is not None: task.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+
+async def build_deflate_index(client, start_pos, comp_size, size, sink=None):
+    builder = IndexBuilder(max(MIN_SPAN, size // MAX_POINTS))
+    try:
+        await stream_inflate(client, start_pos, comp_size, builder, sink)
+    finally:
+        builder.close()
+    return DeflateIndex(builder.points, comp_size, size)
+
+
+class InflatedFileClient:
+    def __init__(self, parent_client, offset, dindex):
+        self.parent = parent_client
+        self.offset = offset
+        self.dindex = dindex
+        self.size = dindex.size
+        self.origin = f"{parent_client.origin}/{offset}z"
+        self.concurrency = parent_client.concurrency
+
+    @classmethod
+    async def open(cls, parent_client, offset, comp_size, size):
+        key = f"{parent_client.origin}/{offset}"
+        dindex = load_deflate_index(parent_client, key)
+        if dindex is None:
+            dindex = await build_deflate_index(parent_client, offset, comp_size, size)
+            store_deflate_index(parent_client, key, dindex)
+        return cls(parent_client, offset, dindex)
+
+    async def get_size(self):
+        return self.size
+
+    def get_index(self):
+        return self.parent.get_index()
+
+    def link(self):
+        return self.parent.link()
+
+    def _span(self, start, end):
+        k = self.dindex.locate(start)
+        c_start, _, o_start, _ = self.dindex.segment(k)
+        c_end = self.dindex.segment(self.dindex.locate(end - 1))[1]
+        return k, c_start, c_end, o_start
+
+    def source_key(self):
+        return self.parent.source_key()
+
+    def report_corrupt(self, start, end):
+        end = min(end, self.size)
+        if end <= start: return
+        _, c_start, c_end, _ = self._span(start, end)
+        self.parent.report_corrupt(self.offset + c_start, self.offset + c_end)
+
+    async def fetch_range(self, start, end):
+        end = min(end, self.size)
+        if end <= start: return b""
+        k, c_start, c_end, o_start = self._span(start, end)
+        data = await self.parent.fetch_range(self.offset + c_start, self.offset + c_end)
+        loop = asyncio.get_running_loop()
+        out = await loop.run_in_executor(None, inflate_segment, data, self.dindex.points[k], end - o_start)
+        return out[start - o_start:]
+
+    async def fetch_ranges(self, ranges):
+        return await asyncio.gather(*(self.fetch_range(s, e) for s, e in ranges))
+
+    async def fetch_tail(self, length):
+        n = min(length, self.size)
+        return await self.fetch_range(self.size - n, self.size)
@@ -0,0 +1,43 @@
+import os
+import zlib
+
+import pytest
+
+from firmware_content_extractor import checksum
+from firmware_content_extractor.checksum import RunningCrc, combine_all, crc32_combine
+
+DATA = os.urandom(300000)
+SPLITS = [0, 1, 3, 4096, 65537, len(DATA) - 1, len(DATA)]
+
+@pytest.fixture(params=["libz", "gf2"])
+def combine(request, monkeypatch):
+    if request.param == "libz" and checksum._combine is None:
+        pytest.skip("libz has no crc32_combine")
+    if request.param == "gf2":
+        monkeypatch.setattr(checksum, "_combine", None)
+
+@pytest.mark.parametrize("split", SPLITS)
+def test_combine_matches_crc32(combine, split):
+    a, b = DATA[:split], DATA[split:]
+    assert crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b)) == zlib.crc32(DATA)
+
+def test_combine_all_out_of_order_chunks(combine):
+    chunks = [(k, DATA[k : k + 40000]) for k in range(0, len(DATA), 40000)]
+    crcs = {k: zlib.crc32(chunk) for k, chunk in reversed(chunks)}
+    assert combine_all((crcs[k], len(chunk)) for k, chunk in chunks) == zlib.crc32(DATA)
+
+def test_fallback_matches_libz_on_large_lengths(monkeypatch):
+    if checksum._combine is None:
+        pytest.skip("libz has no crc32_combine")
+    cases = [(0x12345678, 0x9ABCDEF0, n) for n in (1, 1 << 20, (1 << 32) + 5, (1 << 40) + 12345)]
+    expected = [crc32_combine(*case) for case in cases]
+    monkeypatch.setattr(checksum, "_combine", None)
+    assert [crc32_combine(*case) for case in cases] == expected
+
+def test_running_crc():
+    out = []
+    crc = RunningCrc(out.append)
+    for k in range(0, len(DATA), 70000):
+        crc(DATA[k : k + 70000])
+    assert crc.crc == zlib.crc32(DATA)
+    assert b"".join(out) == DATA
@@ -0,0 +1,76 @@
+import bz2
+import random
+import struct
+
+import pytest
+
+from firmware_content_extractor.delta import bspatch
+
+def offout(v):
+    return struct.pack("<Q", (-v) | (1 << 63) if v < 0 else v)
+
+COMPRESS = {0: lambda data: data, 1: bz2.compress}
+
+def make_patch(ctrl, diff, extra, new_size, kinds=None):
+    # BSDIFF40 when kinds is None, else BSDF2 with a compressor per stream.
+    raw = b"".join(offout(x) + offout(y) + offout(z) for x, y, z in ctrl)
+    if kinds is None:
+        magic, kinds = b"BSDIFF40", (1, 1, 1)
+    else:
+        magic = b"BSDF2" + bytes(kinds)
+    c, d, e = (COMPRESS[k](s) for k, s in zip(kinds, (raw, diff, extra)))
+    return magic + offout(len(c)) + offout(len(d)) + offout(new_size) + c + d + e
+
+def apply_naive(old, ctrl, diff, extra, new_size):
+    new = bytearray(new_size)
+    new_pos = old_pos = d_pos = e_pos = 0
+    for x, y, z in ctrl:
+        for i in range(x):
+            v = diff[d_pos + i]
+            if 0 <= old_pos + i < len(old): v = (v + old[old_pos + i]) & 0xFF
+            new[new_pos + i] = v
+        new_pos, old_pos, d_pos = new_pos + x, old_pos + x, d_pos + x
+        new[new_pos : new_pos + y] = extra[e_pos : e_pos + y]
+        new_pos, e_pos = new_pos + y, e_pos + y
+        old_pos += z
+    return bytes(new)
+
+FORMATS = [None, (0, 1, 0), (1, 1, 1), (0, 0, 0)]
+
+@pytest.mark.parametrize("kinds", FORMATS)
+def test_known_vector(kinds):
+    # b+1 c+1 d+1 d+0, then "XY" from extra, then skip two bytes of old.
+    ctrl = [(4, 2, 2), (2, 0, 0)]
+    patch = make_patch(ctrl, bytes([1, 1, 1, 0, 0, 0]), b"XY", 8, kinds)
+    assert bytes(bspatch(b"abcdefgh", patch)) == b"bcddXYgh"
+
+@pytest.mark.parametrize("kinds", FORMATS)
+def test_random_round_trips(kinds):
+    r = random.Random(1)
+    for _ in range(50):
+        old = bytes(r.getrandbits(8) for _ in range(r.randint(0, 2000)))
+        ctrl = [(r.randint(0, 400), r.randint(0, 200), r.randint(-600, 600)) for _ in range(r.randint(0, 6))]
+        diff = bytes(r.getrandbits(8) for _ in range(sum(x for x, _, _ in ctrl)))
+        extra = bytes(r.getrandbits(8) for _ in range(sum(y for _, y, _ in ctrl)))
+        new_size = len(diff) + len(extra)
+        patch = make_patch(ctrl, diff, extra, new_size, kinds)
+        assert bytes(bspatch(old, patch)) == apply_naive(old, ctrl, diff, extra, new_size)
+
+def test_brotli_streams():
+    brotli = pytest.importorskip("brotli")
+    COMPRESS[2] = brotli.compress
+    try:
+        patch = make_patch([(4, 2, 2), (2, 0, 0)], bytes([1, 1, 1, 0, 0, 0]), b"XY", 8, (2, 2, 2))
+    finally:
+        del COMPRESS[2]
+    assert bytes(bspatch(b"abcdefgh", patch)) == b"bcddXYgh"
+
+def test_corrupt_patches():
+    with pytest.raises(Exception, match="Unknown bsdiff patch format"):
+        bspatch(b"", b"NOTDIFF0" + bytes(24))
+    # The control block writes past the declared output size.
+    with pytest.raises(Exception, match="Corrupt bsdiff patch"):
+        bspatch(b"abcd", make_patch([(4, 2, 0)], bytes(4), b"XY", 5))
+    # The output is declared longer than the control block fills.
+    with pytest.raises(Exception, match="Corrupt bsdiff patch"):
+        bspatch(b"abcd", make_patch([(4, 0, 0)], bytes(4), b"", 6))
@@ -0,0 +1,66 @@
+import hashlib
+
+from firmware_content_extractor.manifest import Manifest, read_varint
+
+def varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def field(fn, value):
+    # Varint for ints, length-delimited for bytes.
+    if isinstance(value, int): return varint(fn << 3) + varint(value)
+    return varint(fn << 3 | 2) + varint(len(value)) + value
+
+def extent(start, blocks):
+    return field(1, start) + field(2, blocks)
+
+DIGEST = hashlib.sha256(b"op").digest()
+BIG = (1 << 40) + 7
+
+def manifest_bytes():
+    ops = [
+        field(1, 0) + field(2, 0) + field(3, 4096) + field(6, extent(0, 1)) + field(8, DIGEST),
+        # Unknown fields of every wire type are skipped.
+        field(1, 8) + field(15, 3) + varint(16 << 3 | 1) + bytes(8) + varint(17 << 3 | 5) + bytes(4)
+        + field(2, BIG) + field(3, 300) + field(6, extent(5, 2)) + field(6, extent(9, 1)),
+        field(1, 6) + field(6, extent(1, 4)),
+        field(1, 4) + field(4, extent(20, 3)) + field(6, extent(12, 3)) + field(9, DIGEST),
+    ]
+    part = field(1, b"boot") + field(7, field(1, 15 * 4096) + field(2, b"\x11" * 32))
+    part += field(6, field(1, 14 * 4096) + field(2, b"\x22" * 32))
+    part += b"".join(field(8, op) for op in ops)
+    return field(3, 4096) + field(12, b"ignored") + field(13, part) + field(13, field(1, b"empty"))
+
+def test_varint():
+    for n in (0, 1, 127, 128, 300, BIG, (1 << 63) + 5):
+        assert read_varint(varint(n) + b"\xff", 0) == (n, len(varint(n)))
+
+def test_partition_columns():
+    manifest = Manifest.parse(memoryview(manifest_bytes()))
+    assert manifest.block_size == 4096
+    assert list(manifest.partitions) == ["boot", "empty"]
+    part = manifest.partitions["boot"]
+    assert (part.size, part.hash) == (15 * 4096, b"\x11" * 32)
+    assert (part.old_size, part.old_hash) == (14 * 4096, b"\x22" * 32)
+    assert len(part) == 4
+    assert list(part.types) == [0, 8, 6, 4]
+    assert list(part.offsets) == [0, BIG, 0, 0]
+    assert list(part.lengths) == [4096, 300, 0, 0]
+    assert [list(part.extents(i)) for i in range(4)] == [[(0, 1)], [(5, 2), (9, 1)], [(1, 4)], [(12, 3)]]
+    assert [list(part.src_extents(i)) for i in range(4)] == [[], [], [], [(20, 3)]]
+    assert [part.digest(i) for i in range(4)] == [DIGEST, None, None, None]
+    assert part.src_digest(3) == DIGEST
+    assert part.output_blocks() == 15
+    assert len(manifest.partitions["empty"]) == 0
+
+def test_dict_round_trip():
+    manifest = Manifest.parse(manifest_bytes())
+    restored = Manifest.from_dict(manifest.to_dict())
+    assert restored.to_dict() == manifest.to_dict()
+    part = restored.partitions["boot"]
+    assert list(part.extents(1)) == [(5, 2), (9, 1)]
+    assert part.offsets[1] == BIG
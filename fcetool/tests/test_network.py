@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from firmware_content_extractor.network import NetworkManager, parse_content_range
+
+def read_multipart(body, boundary="XYZ"):
+    async def main():
+        stream = asyncio.StreamReader()
+        stream.feed_data(body)
+        stream.feed_eof()
+        return await NetworkManager._read_multipart(stream, boundary)
+
+    return asyncio.run(main())
+
+def test_parse_content_range():
+    assert parse_content_range("bytes 0-3/100") == (0, 3, 100)
+    assert parse_content_range(" bytes 10-19/*") == (10, 19, None)
+
+def test_byteranges():
+    body = (
+        b"\r\n--XYZ\r\n"
+        b"Content-Type: application/octet-stream\r\n"
+        b"Content-Range: bytes 0-3/100\r\n"
+        b"\r\n"
+        b"abcd"
+        b"\r\n--XYZ\r\n"
+        b"content-range: bytes 10-15/100\r\n"
+        b"\r\n"
+        b"\r\n--X\n"
+        b"\r\n--XYZ--\r\n"
+    )
+    parts = read_multipart(body)
+    # Part bodies are read by length, so delimiter-like bytes inside them
+    # are data.
+    assert parts == [(0, b"abcd"), (10, b"\r\n--X\n")]
+    ranges = [(1, 3), (10, 16), (2, 12), (98, 100)]
+    assert NetworkManager._slice_parts(parts, ranges) == [b"bc", b"\r\n--X\n", None, None]
+
+def test_missing_closing_delimiter():
+    body = b"--a'b\r\nContent-Range: bytes 5-5/10\r\n\r\nz\r\n"
+    assert read_multipart(body, "a'b") == [(5, b"z")]
+
+def test_malformed_byteranges():
+    with pytest.raises(Exception, match="Malformed multipart"):
+        read_multipart(b"--OTHER\r\nContent-Range: bytes 0-0/1\r\n\r\na\r\n--XYZ--\r\n")
+    with pytest.raises(Exception, match="without Content-Range"):
+        read_multipart(b"--XYZ\r\nContent-Type: text/plain\r\n\r\na\r\n--XYZ--\r\n")
+    # A part shorter than its Content-Range.
+    with pytest.raises(asyncio.IncompleteReadError):
+        read_multipart(b"--XYZ\r\nContent-Range: bytes 0-9/10\r\n\r\nabc")
@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import struct
+
+import pytest
+
+from firmware_content_extractor.superimg import (
+    CHUNK_DONT_CARE, CHUNK_FILL, CHUNK_RAW, LP_GEOMETRY_MAGIC, LP_HEADER_MAGIC,
+    SparseView, read_lp_metadata, read_sparse_chunks,
+)
+
+BLOCK = 4096
+FILL = bytes.fromhex("01abcdef")
+
+class BytesClient:
+    def __init__(self, data):
+        self.data = data
+
+    async def fetch_range(self, start, end):
+        return self.data[start:end]
+
+    async def fetch_ranges(self, ranges):
+        return [self.data[s:e] for s, e in ranges]
+
+def sparse_image(major=1):
+    raw = bytes(range(256)) * (2 * BLOCK // 256)
+    body = (
+        struct.pack("<HHII", CHUNK_RAW, 0, 2, 12 + len(raw)) + raw
+        + struct.pack("<HHII", CHUNK_FILL, 0, 1, 16) + FILL
+        + struct.pack("<HHII", CHUNK_DONT_CARE, 0, 3, 12)
+        + struct.pack("<HHII", 0xCAC4, 0, 0, 16) + bytes(4)
+    )
+    head = struct.pack("<IHHHHIIII", 0xED26FF3A, major, 0, 28, 12, BLOCK, 6, 4, 0)
+    unsparsed = raw + FILL * (BLOCK // 4) + bytes(3 * BLOCK)
+    return head + body, unsparsed
+
+def test_sparse_chunks_and_view():
+    image, unsparsed = sparse_image()
+
+    async def main():
+        client = BytesClient(image)
+        chunks = await read_sparse_chunks(client, len(image))
+        assert chunks == [
+            [0, 2 * BLOCK, CHUNK_RAW, 40],
+            [2 * BLOCK, BLOCK, CHUNK_FILL, struct.unpack("<I", FILL)[0]],
+            [3 * BLOCK, 3 * BLOCK, CHUNK_DONT_CARE, 0],
+        ]
+        view = SparseView(client, chunks)
+        assert view.size == len(unsparsed)
+        # Ranges across chunk edges and starting mid fill word.
+        ranges = [(0, len(unsparsed)), (4000, 13000), (2 * BLOCK + 3, 2 * BLOCK + 9), (5 * BLOCK, 6 * BLOCK)]
+        assert await view.fetch_ranges(ranges) == [unsparsed[s:e] for s, e in ranges]
+        with pytest.raises(Exception, match="past the end"):
+            await view.fetch_range(0, len(unsparsed) + 1)
+
+    asyncio.run(main())
+
+def test_not_sparse_or_unsupported():
+    image, unsparsed = sparse_image(major=2)
+    assert asyncio.run(read_sparse_chunks(BytesClient(unsparsed), len(unsparsed))) is None
+    with pytest.raises(Exception, match="Unsupported sparse image version 2"):
+        asyncio.run(read_sparse_chunks(BytesClient(image), len(image)))
+
+def geometry(max_size):
+    body = struct.pack("<II32sIII", LP_GEOMETRY_MAGIC, 52, bytes(32), max_size, 1, BLOCK)
+    body = body[:8] + hashlib.sha256(body).digest() + body[40:]
+    return body.ljust(BLOCK, b"\0")
+
+def lp_image(partitions, max_size=8192):
+    # partitions: {name: [(sectors, target, data, source)]}
+    ptab, etab = b"", b""
+    for name, extents in partitions.items():
+        ptab += struct.pack("<36sIIII", name.encode(), 0, len(etab) // 24, len(extents), 0)
+        etab += b"".join(struct.pack("<QIQI", *e) for e in extents)
+    tables = ptab + etab
+    descs = struct.pack("<III", 0, len(ptab) // 52, 52) + struct.pack("<III", len(ptab), len(etab) // 24, 24)
+    descs += struct.pack("<III", len(tables), 0, 48) + struct.pack("<III", len(tables), 0, 64)
+    header = struct.pack("<IHHI32sI32s", LP_HEADER_MAGIC, 10, 0, 128, bytes(32), len(tables), hashlib.sha256(tables).digest())
+    header = (header + descs).ljust(128, b"\0")
+    header = header[:12] + hashlib.sha256(header).digest() + header[44:]
+    return bytes(4096) + geometry(max_size) * 2 + (header + tables).ljust(max_size, b"\0")
+
+def test_lp_metadata():
+    image = lp_image({
+        "system_a": [(8, 0, 100, 0), (4, 1, 0, 0)],
+        "vendor_a": [(16, 0, 200, 0)],
+        "system_b": [],
+    })
+    assert asyncio.run(read_lp_metadata(BytesClient(image))) == {
+        "system_a": [[100 * 512, 8 * 512, True], [0, 4 * 512, False]],
+        "vendor_a": [[200 * 512, 16 * 512, True]],
+        "system_b": [],
+    }
+
+def test_lp_backup_geometry():
+    image = bytearray(lp_image({"odm_a": [(1, 0, 50, 0)]}))
+    image[4096 + 20] ^= 0xFF
+    assert asyncio.run(read_lp_metadata(BytesClient(bytes(image)))) == {"odm_a": [[50 * 512, 512, True]]}
+    image[8192 + 20] ^= 0xFF
+    with pytest.raises(Exception, match="No valid LP metadata geometry"):
+        asyncio.run(read_lp_metadata(BytesClient(bytes(image))))
+
+def test_lp_metadata_errors():
+    image = bytearray(lp_image({"odm_a": [(1, 0, 50, 0)]}))
+    image[3 * 4096 + 128] ^= 0xFF
+    with pytest.raises(Exception, match="checksum mismatch"):
+        asyncio.run(read_lp_metadata(BytesClient(bytes(image))))
+    with pytest.raises(Exception, match="another block device"):
+        asyncio.run(read_lp_metadata(BytesClient(lp_image({"odm_a": [(1, 0, 50, 1)]}))))